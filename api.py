@@ -1,3 +1,6 @@
+import collections
+import columnar
+import config
 import re
 import recorder
 import sys
@@ -6,200 +9,456 @@ from prettytable import PrettyTable
 
 sys.setrecursionlimit(1000000)
 
+# every token is either a value (string, number or '?') or a word (name,
+# punctuation or any other character, left for the parser to reject)
+TOKEN = re.compile(r"\s*(?:('(?:[^']|'')*'|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|\?)"
+                   r"|([A-Za-z_#][\w#.$]*|<=|>=|<>|\S))")
+
+VALUE, NAME, OP = range(3)
+COMPARE_OPS = ('<=', '>=', '<>', '=', '<', '>')
+
+# literals of data statements become parameters, so statements differing
+# only in their values share one parsed plan
+PARAMETERIZED_OPS = ('select', 'insert', 'delete')
+
 def result_to_table(result):
-    if len(result) == 0:
+    """Table of the rows of a recorder.Cursor, columns in select order."""
+    rows = iter(result)
+
+    first = next(rows, None)
+    if first is None:
         return "Empty set."
 
-    columns = result[0].keys()
+    columns = result.columns
     x = PrettyTable(columns)
     x.padding_width = 1 # One space between column edges and contents (default)
 
-    map(lambda row:x.add_row(row.values()),result)
+    x.add_row([first[column] for column in columns])
+    for row in rows:
+        x.add_row([row[column] for column in columns])
 
     return x
 
-class Tokenizer(object):
+def scan(query):
+    """(value, word) text of every token, one of them empty, in a single
+    pass over the query."""
+    return TOKEN.findall(query)
 
-    def __init__(self, sql_query):
-        self.query = sql_query
 
-        self.tokenizer = {
-            "drop_table": self.drop_table,
-            "drop_index": self.drop_index,
-            "create_table": self.create_table,
-            "create_index": self.create_index,
-            "select": self.select,
-            "insert": self.insert,
-            "delete": self.delete,
-            "nop": self.nop
-        }
+def literal_value(text):
+    """Typed value of a value token, None for a '?' placeholder."""
+    if text[0] == "'":
+        return text[1:-1].replace("''", "'")
+    if text == '?':
+        return None
+    if '.' in text or 'e' in text or 'E' in text:
+        return float(text)
+    return int(text)
+
+
+def tokenize(query):
+    """(kind, text, value) of every token. Values are converted already,
+    names are lower case for keyword matching."""
+    tokens = []
+
+    for value, word in scan(query):
+        if value:
+            tokens.append((VALUE, value, literal_value(value)))
+        elif word[0].isalpha() or word[0] in '_#':
+            tokens.append((NAME, word, word.lower()))
+        else:
+            tokens.append((OP, word, word))
+
+    return tokens
+
+
+class Parameter(object):
+    """Placeholder for the index-th value of a statement."""
+
+    __slots__ = ('index',)
+
+    def __init__(self, index):
+        self.index = index
+
+
+class Parser(object):
+    """Recursive descent parser over the tokens of one statement.
+
+    With parameterize set every value becomes a Parameter, numbered in
+    order of appearance, for PreparedStatement to bind."""
+
+    def __init__(self, tokens, parameterize = False):
+        self.tokens = tokens
+        self.pos = 0
+        self.parameterize = parameterize
+        self.parameters = 0
+
+    def error(self):
+        if self.pos < len(self.tokens):
+            raise Exception("Syntax error near '%s'" % self.tokens[self.pos][1])
+        raise Exception('Syntax error, unexpected end of statement')
+
+    def accept(self, word):
+        """consume a keyword or punctuation if it comes next"""
+        if self.pos < len(self.tokens):
+            kind, text, value = self.tokens[self.pos]
+            if (kind == NAME or kind == OP) and value == word:
+                self.pos += 1
+                return True
+        return False
+
+    def expect(self, word):
+        if not self.accept(word):
+            self.error()
+
+    def name(self):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] == NAME:
+            self.pos += 1
+            return self.tokens[self.pos - 1][1]
+        self.error()
+
+    def number(self):
+        if self.pos < len(self.tokens) and isinstance(self.tokens[self.pos][2], (int, float)):
+            self.pos += 1
+            return self.tokens[self.pos - 1][2]
+        self.error()
+
+    def value(self):
+        if self.pos < len(self.tokens) and self.tokens[self.pos][0] == VALUE:
+            value = self.tokens[self.pos][2]
+            if not self.parameterize:
+                if value is None:
+                    self.error()
+                self.pos += 1
+                return value
+
+            self.pos += 1
+            self.parameters += 1
+            return Parameter(self.parameters - 1)
+        self.error()
+
+    def statement(self):
+        if self.accept(';'):
+            return {'op': 'nop'}
+
+        if self.accept('select'):
+            op_dict = self.select()
+        elif self.accept('insert'):
+            op_dict = self.insert()
+        elif self.accept('delete'):
+            op_dict = self.delete()
+        elif self.accept('create'):
+            if self.accept('table'):
+                op_dict = self.create_table()
+            else:
+                self.expect('index')
+                op_dict = self.create_index()
+        elif self.accept('drop'):
+            if self.accept('table'):
+                op_dict = {'op': 'drop_table', 'table_name': self.name()}
+            else:
+                self.expect('index')
+                op_dict = {'op': 'drop_index', 'index_name': self.name()}
+        elif self.accept('vacuum'):
+            op_dict = {'op': 'vacuum', 'table_name': self.name()}
+        else:
+            self.error()
 
-    def tokenize(self):
-        for op, func in self.tokenizer.iteritems():
-            result = func()
-            if result:
-                return result
-
-    def nop(self):
-        matches = re.match('^\s*;', self.query)
-        return{
-            'op': 'nop'
-        } if matches else None
-
-    def drop_index(self):
-        matches = re.match('drop\s+index\s+(?P<index_name>\S+)\s*;', self.query)
-        return{
-            'op': 'drop_index',
-            'index_name': matches.group('index_name'),
-        } if matches else None
+        self.expect(';')
+        if self.pos < len(self.tokens):
+            self.error()
 
-    def create_index(self):
-        matches = re.match(
-            'create\s+index\s+(?P<index_name>\S+)\s+on\s+(?P<table_name>\S+)\s*\(\s*(?P<key>\S+)\s*\)\s*;',
-            self.query)
-        return{
-            'op': 'create_index',
-            'table_name': matches.group('table_name'),
-            'index_name': matches.group('index_name'),
-            'key': matches.group('key'),
-        } if matches else None
-
-    def drop_table(self):
-        matches = re.match('drop\s+table\s+(?P<table_name>\S+)\s*;', self.query)
-        return{
-            'op': 'drop_table',
-            'table_name': matches.group('table_name'),
-        } if matches else None
+        return op_dict
 
     def create_table(self):
+        table_name = self.name()
 
-        def match_schema(schema):
-            primary_key_match = re.match(r'\s*primary\s+key\s*\(\s*(?P<key>\S+)\s*\)\s*', schema)
+        self.expect('(')
+        schemas = [self.column()]
+        while self.accept(','):
+            schemas.append(self.column())
+        self.expect(')')
 
-            if primary_key_match:
-                return {
-                    'type': 'primary_key',
-                    'name': primary_key_match.group('key')
-                }
-
-            schema_match = re.match(r'(?P<name>\S+)\s*(?P<type>\S+(\s*\(\d+\))?)\s*(?P<extra>.*)', schema)
-
-            char_match = re.match(r'char\s*\((?P<length>\d+)\)\s*', schema_match.group('type'))
-
-            unique_match = re.match('\s*unique\s*', schema_match.group('extra'))
+        return {
+            'op': 'create_table',
+            'table_name': table_name,
+            'schemas': schemas
+        }
 
-            schema_dict = {
-                'name': schema_match.group('name'),
-                'unique': unique_match is not None
+    def column(self):
+        if self.accept('primary'):
+            self.expect('key')
+            self.expect('(')
+            name = self.name()
+            self.expect(')')
+            return {
+                'type': 'primary_key',
+                'name': name
             }
 
-            if char_match:
-                schema_dict['type'] = 'char'
-                schema_dict['length'] = int(char_match.group('length'))
-                if schema_dict['length'] is None or schema_dict['length'] < 1:
-                    raise Exception('Char length is not correctly specified.')
-            else:
-                schema_dict['type'] = schema_match.group('type')
+        schema_dict = {
+            'name': self.name(),
+            'type': self.name().lower()
+        }
 
-            return schema_dict
+        if schema_dict['type'] == 'char':
+            self.expect('(')
+            schema_dict['length'] = self.number()
+            self.expect(')')
+            if not isinstance(schema_dict['length'], int) or schema_dict['length'] < 1:
+                raise Exception('Char length is not correctly specified.')
 
-        exp_base = re.compile('\s*create\s+table\s+(?P<table_name>\S+)\s*\(\s*(?P<schema>.+)\s*\)\s*;')
-        matches = exp_base.match(self.query)
+        schema_dict['unique'] = self.accept('unique')
 
-        if not matches:
-            return None
+        return schema_dict
 
-        schemas = re.compile(',\s*').split(matches.group('schema'))
+    def create_index(self):
+        index_name = self.name()
+        self.expect('on')
+        table_name = self.name()
+        self.expect('(')
+        key = self.name()
+        self.expect(')')
 
-        return{
-            'op': 'create_table',
-            'table_name': matches.group('table_name'),
-            'schemas': map(match_schema, schemas)
+        return {
+            'op': 'create_index',
+            'table_name': table_name,
+            'index_name': index_name,
+            'key': key
         }
 
-    def match_conditions(self, extra):
-        if not extra:
+    def conditions(self):
+        if not self.accept('where'):
             return None
 
-        conditions_match = re.match(r'where\s+(?P<conditions>.+)\s*', extra)
-        conditions = re.split(r'\s*and\s*', conditions_match.group('conditions'))
+        conditions = [self.condition()]
+        while self.accept('and'):
+            conditions.append(self.condition())
+        return conditions
 
-        def match_each_conditions(condition):
-            matches = re.match(r'(?P<left>\S+)\s*(?P<op>(<=|>=|=|<>|>|<))\s*(?P<right>.+)\s*', condition)
-            return {
-                'left': matches.group('left'),
-                'right': matches.group('right'),
-                'op': matches.group('op')
-            }
-        return map(match_each_conditions, conditions)
+    def condition(self):
+        left = self.name()
 
-    def select(self):
+        if self.pos >= len(self.tokens) or self.tokens[self.pos][1] not in COMPARE_OPS:
+            self.error()
+        op = self.tokens[self.pos][1]
+        self.pos += 1
 
-        def match_colums(colunms):
-            return re.split(r'\s*,\s*', colunms)
-
-        exp_base = re.compile('select\s+(?P<colunms>[\w\d\*,]+)\s+from\s+(?P<table_name>\S+)\s*(?P<extra>.+)?\s*;')
-        matches = exp_base.match(self.query)
+        return {
+            'left': left,
+            'right': self.value(),
+            'op': op
+        }
 
-        if not matches:
-            return None
+    def select(self):
+        colunms = []
+        aggregates = []
+
+        if self.accept('*'):
+            colunms.append('*')
+        else:
+            self.select_item(colunms, aggregates)
+            while self.accept(','):
+                self.select_item(colunms, aggregates)
+
+        self.expect('from')
+        table_name = self.name()
+        conditions = self.conditions()
+
+        group_by = None
+        if self.accept('group'):
+            self.expect('by')
+            group_by = [self.name()]
+            while self.accept(','):
+                group_by.append(self.name())
 
         return {
             'op': 'select',
-            'table_name': matches.group('table_name'),
-            'colunms': match_colums(matches.group('colunms')),
-            'conditions': self.match_conditions(matches.group('extra'))
+            'table_name': table_name,
+            'colunms': colunms,
+            'aggregates': aggregates,
+            'group_by': group_by,
+            'conditions': conditions
         }
 
+    def select_item(self, colunms, aggregates):
+        name = self.name()
+
+        if name.lower() in recorder.AGGREGATE_FUNCTIONS and self.accept('('):
+            if self.accept('*'):
+                column = '*'
+            else:
+                column = self.name()
+            self.expect(')')
+            aggregates.append((name.lower(), column))
+        else:
+            colunms.append(name)
+
     def insert(self):
-        exp_base = re.compile('insert\s+into\s+(?P<table_name>\S+)\s+values\s+\((?P<values>.+)\)\s*;')
-        matches = exp_base.match(self.query)
+        self.expect('into')
+        table_name = self.name()
+        self.expect('values')
 
-        if not matches:
-            return None
+        rows = [self.row()]
+        while self.accept(','):
+            rows.append(self.row())
 
         return {
             "op": 'insert',
-            "table_name": matches.group("table_name"),
-            "values": re.split(r"\s*,\s*", matches.group("values"))
+            "table_name": table_name,
+            "rows": rows
         }
 
-    def delete(self):
-
-        exp_base = re.compile('delete\s+from\s+(?P<table_name>\S+)\s*(?P<extra>.+)?\s*;')
-        matches = exp_base.match(self.query)
+    def row(self):
+        self.expect('(')
+        values = [self.value()]
+        while self.accept(','):
+            values.append(self.value())
+        self.expect(')')
+        return values
 
-        if not matches:
-            return None
+    def delete(self):
+        self.expect('from')
 
         return {
             'op': 'delete',
-            'table_name': matches.group('table_name'),
-            'conditions': self.match_conditions(matches.group('extra'))
+            'table_name': self.name(),
+            'conditions': self.conditions()
         }
 
+
+def parse_statement(query):
+    """op_dict of one statement, values included, without the cache."""
+    return Parser(tokenize(query)).statement()
+
+
 def flush():
-    recorder.update_catalog_file()
+    recorder.commit()
+
+def close():
+    recorder.checkpoint()
 
 def do_query(query):
+    ret = execute(query)
+
+    if isinstance(ret, recorder.Cursor):
+        return result_to_table(ret)
+
+    return ret
+
+class StatementCache(object):
+    """Parsed statements by their token text, least recently used dropped."""
+
+    def __init__(self, size):
+        self.size = size
+        self._statements = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        op_dict = self._statements.pop(key, None)
+        if op_dict is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._statements[key] = op_dict
+        return op_dict
+
+    def put(self, key, op_dict):
+        self._statements[key] = op_dict
+        while len(self._statements) > self.size:
+            self._statements.popitem(False)
+
+
+statement_cache = StatementCache(config.statement_cache_size)
+
+
+class PreparedStatement(object):
+    """A parsed statement whose '?' placeholders are bound on execute()."""
 
-    sql_tokenizer = Tokenizer(query)
-    try:
-        op_dict = sql_tokenizer.tokenize()
-    except:
-        raise Exception('Syntax error')
+    def __init__(self, op_dict, literals):
+        self.op_dict = op_dict
+        # literal values in statement order, None where a '?' stands
+        self.literals = literals
+        self.parameter_count = literals.count(None)
+
+    def bind(self, params):
+        if len(params) != self.parameter_count:
+            raise Exception('Expected %d parameters, got %d.' % (self.parameter_count, len(params)))
+
+        if not self.literals:
+            return self.op_dict
+
+        params = iter(params)
+        values = [next(params) if x is None else x for x in self.literals]
+
+        op_dict = dict(self.op_dict)
+        if op_dict.get('rows'):
+            op_dict['rows'] = [[values[x.index] for x in row] for row in op_dict['rows']]
+        if op_dict.get('conditions'):
+            op_dict['conditions'] = [dict(condition, right = values[condition['right'].index])
+                                     for condition in op_dict['conditions']]
+        return op_dict
+
+    def execute(self, *params):
+        return run(self.bind(params))
+
+
+def prepare(query):
+    tokens = scan(query)
+
+    if tokens and tokens[0][1].lower() in PARAMETERIZED_OPS:
+        literals = [literal_value(value) for value, word in tokens if value]
+        key = ' '.join([word or '?' for value, word in tokens])
+        parameterize = True
+    else:
+        literals = []
+        key = ' '.join([value or word for value, word in tokens])
+        parameterize = False
+
+    op_dict = statement_cache.get(key)
     if op_dict is None:
-        raise Exception('Syntax error')
+        op_dict = Parser(tokenize(query), parameterize).statement()
+        statement_cache.put(key, op_dict)
+
+    return PreparedStatement(op_dict, literals)
+
+
+def execute(query, *params):
+    """Run one statement. A select returns a recorder.Cursor whose rows are
+    only read as they are fetched."""
+    return prepare(query).execute(*params)
+
+
+def select_aggregate(op_dict):
+    group_by = op_dict['group_by'] or []
+
+    for column in op_dict['colunms']:
+        if column not in group_by:
+            raise Exception('Column %s is neither aggregated nor grouped by.' % column)
+
+    rows = recorder.select_aggregate(op_dict['table_name'], op_dict['aggregates'],
+                                     op_dict['conditions'], group_by)
+
+    columns = op_dict['colunms'] + [columnar.aggregate_label(function, column)
+                                    for function, column in op_dict['aggregates']]
+    return recorder.Cursor(columns, iter([dict([(x, row[x]) for x in columns]) for row in rows]))
+
 
+def run(op_dict):
     ret = None
 
     if op_dict['op'] == 'create_table':
-        ret = recorder.create_table_file(op_dict['table_name'], op_dict['schemas'])
+        # the parsed statement is cached, the recorder keeps its own schemas
+        ret = recorder.create_table_file(op_dict['table_name'],
+                                         [schema.copy() for schema in op_dict['schemas']])
     elif op_dict['op'] == 'insert':
-        ret = recorder.insert_record(op_dict['table_name'], op_dict['values'])
+        recorder.insert_records(op_dict['table_name'], op_dict['rows'])
+    elif op_dict['op'] == 'select' and (op_dict['aggregates'] or op_dict['group_by']):
+        ret = select_aggregate(op_dict)
     elif op_dict['op'] == 'select':
-        records = recorder.select_record(op_dict['table_name'],op_dict['colunms'],op_dict['conditions'])
-        ret = result_to_table(records)
+        ret = recorder.select_cursor(op_dict['table_name'],op_dict['colunms'],op_dict['conditions'])
     elif op_dict['op'] == 'create_index':
         ret = recorder.create_index(op_dict['table_name'],op_dict['index_name'],op_dict['key'])
     elif op_dict['op'] == 'drop_index':
@@ -208,10 +467,12 @@ def do_query(query):
         ret = recorder.delete_records(op_dict['table_name'],op_dict['conditions'])
     elif op_dict['op'] == 'drop_table':
         ret = recorder.delete_table_file(op_dict['table_name'])
+    elif op_dict['op'] == 'vacuum':
+        ret = recorder.vacuum_table(op_dict['table_name'])
     elif op_dict['op'] == 'nop':
         return None
     else:
-        raise Exception("%s doesn\'t support" % query)
+        raise Exception("%s doesn\'t support" % op_dict['op'])
 
     return ret
 
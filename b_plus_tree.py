@@ -48,6 +48,78 @@ class BPTree(object):
         self._maxchildren = 2 * self.degree
         #self.disk_write(self.root)
 
+    @classmethod
+    def bulk_load(cls, pairs, degree = 3, fill_factor = 1.0, presorted = False):
+        """Build a tree bottom-up from (key, value) pairs.
+
+        Pairs are sorted unless presorted is set; duplicate keys are merged
+        into one posting list. Leaves and internal nodes are packed to
+        fill_factor of their capacity, so building costs a sort plus one
+        linear pass instead of one descent per pair."""
+        if not presorted:
+            pairs = sorted(pairs, key = lambda pair: pair[0])
+
+        grouped = []
+        for key, value in pairs:
+            if grouped and grouped[-1][0] == key:
+                grouped[-1][1].append(value)
+            else:
+                grouped.append((key, [value]))
+
+        tree = cls(degree)
+        tree._build(grouped, fill_factor)
+        return tree
+
+    def _build(self, items, fill_factor = 1.0):
+        """Replace the content with items, a sorted list of (key, posting)."""
+        if not items:
+            self.root = BPNode()
+            return
+
+        def chunk(entries, capacity, minimum):
+            target = max(min(int(capacity * fill_factor), capacity), minimum, 1)
+            count = (len(entries) + target - 1) // target
+            if count > 1 and len(entries) // count < minimum:
+                count = max(len(entries) // minimum, 1)
+            base, extra = divmod(len(entries), count)
+            start = 0
+            for i in xrange(count):
+                end = start + base + (1 if i < extra else 0)
+                yield entries[start:end]
+                start = end
+
+        level = []
+        prev = None
+        for group in chunk(items, self._maxkeys, self._minkeys):
+            leaf = BPNode()
+            leaf.keys = [k for k, v in group]
+            leaf.values = [v for k, v in group]
+            if prev is not None:
+                prev.next = leaf
+            prev = leaf
+            # (lowest key in subtree, node)
+            level.append((leaf.keys[0], leaf))
+
+        while len(level) > 1:
+            parents = []
+            for group in chunk(level, self._maxchildren, self._minchildren):
+                node = BPNode()
+                node.children = [child for k, child in group]
+                node.keys = [k for k, child in group[1:]]
+                parents.append((group[0][0], node))
+            level = parents
+
+        self.root = level[0][1]
+
+    def __getstate__(self):
+        # pickle a flat item list rather than the recursive node structure;
+        # it is restored by bulk loading
+        return {'degree': self.degree, 'items': self.items()}
+
+    def __setstate__(self, state):
+        self.__init__(state['degree'])
+        self._build(state['items'])
+
     def search(self, node, key):
         i = bisect.bisect_left(node.keys, key)
         if i < len(node.keys) and key == node.keys[i]:
@@ -104,8 +176,10 @@ class BPTree(object):
 
     def insert(self, key, value):
 
-        if key in self.keys():
-            self[key].append(value)
+        # a single descent finds an existing posting list to append to
+        node, i = self.search(self.root, key)
+        if node is not None:
+            node.values[i].append(value)
             return
 
         if len(self.root.keys) == self._maxkeys:
@@ -127,256 +201,146 @@ class BPTree(object):
             x.values.insert(i, value)
             #self.disk_write(x)
         else:
+            # a key equal to a separator belongs to its right subtree
+            i = bisect.bisect_right(x.keys, key)
             #self.disk_read(x.children[i])
             if len(x.children[i].keys) == self._maxkeys:
                 self.split_child(x, i, x.children[i])
-                if key > x.keys[i]:
+                if key >= x.keys[i]:
                     i += 1
             self.insert_nonfull(x.children[i], key, value)
 
     def delete(self, key ,value):
-        if self[key] is None:
+        posting = self.get(key)
+        if posting is None:
             return
 
-        self[key].remove(value)
+        posting.remove(value)
 
-        if len(self[key]) == 0:
+        if len(posting) == 0:
             self._delete(self.root, key)
 
     def _delete(self, node, key):
-        """fixed!!!"""
-        if key in node.keys:
-            if node.is_leaf():
-                index = node.keys.index(key)
-                node.keys.pop(index)
-                node.values.pop(index)
-            else:
-                ki = node.keys.index(key)
-                if len(node.children[ki].keys) >= self.degree:
-                    nmax = node.children[ki].max()
-                    nmin = node.children[ki+1].min()
-                    kp = nmax.keys[-1]
-                    self._delete(node.children[ki], kp)
-                    node.keys[ki] = kp
-                    nmin.keys[0] = kp
-                    nmin.values[0] = nmax.values[-1]
-                elif len(node.children[ki+1].keys) >= self.degree:
-                    nmin = node.children[ki+1].min()
-                    nmin.keys.pop(0)
-                    nmin.values.pop(0)
-                    kp = nmin.keys[0]
-                    node.keys[ki] = nmin.keys[0]
+        """Remove key from the subtree of node in one descent. A child at
+        the minimum is topped up from a sibling, or merged with one, before
+        descending into it, so no node underflows on the way back; the leaf
+        chain is relinked on merges. A separator only bounds its subtrees
+        and may outlive the key it was copied from."""
+        if node.is_leaf():
+            i = bisect.bisect_left(node.keys, key)
+            if i < len(node.keys) and node.keys[i] == key:
+                node.keys.pop(i)
+                node.values.pop(i)
+            return
+
+        ci = bisect.bisect_right(node.keys, key)
+        child = node.children[ci]
+
+        if len(child.keys) == self._minkeys:
+            if ci >= 1 and len(node.children[ci-1].keys) > self._minkeys:
+                left = node.children[ci-1]
+                if child.is_leaf():
+                    child.keys.insert(0, left.keys.pop())
+                    child.values.insert(0, left.values.pop())
+                    node.keys[ci-1] = child.keys[0]
                 else:
-                    rnode = node.children.pop(ki+1)
-                    if node.children[ki].is_leaf():
-                        node.keys.pop(ki)
-                        node.children[ki].values.extend(rnode.values)
-                        node.children[ki].next = rnode.next
-                    else:
-                        node.children[ki].keys.append(node.keys.pop(ki))
-                        node.children[ki].keys.extend(rnode.keys)
-                        node.children[ki].children.extend(rnode.children)
-                    if node == self.root and not node.keys:
-                        self.root = node.children[ki]
-                    self._delete(node.children[ki], key)
-        else:
-            ci = bisect.bisect_left(node.keys, key)
-            if len(node.children[ci].keys) == self._minkeys:
-                if ci >= 1 and len(node.children[ci-1].keys) > self._minkeys:
-                    if node.children[ci].is_leaf():
-                        kp = node.children[ci-1].keys.pop(-1)
-                        vp = node.children[ci-1].values.pop(-1)
-                        node.keys[ci-1] = kp
-                        node.children[ci].keys.insert(0, kp)
-                        node.children[ci].values.insert(0, vp)
-                    else:
-                        node.children[ci].keys.insert(0, node.keys[ci-1])
-                        node.keys[ci-1] = node.children[ci-1].keys.pop(-1)
-                        node.children[ci].children = node.children[ci-1].children[-1:] + node.children[ci].children
-                        node.children[ci-1].children = node.children[ci-1].children[:-1]
-                    self._delete(node.children[ci], key)
-                elif ci < len(node.keys) and len(node.children[ci+1].keys) > self._minkeys:
-                    if node.children[ci].is_leaf():
-                        kp = node.children[ci+1].keys.pop(0)
-                        vp = node.children[ci+1].values.pop(0)
-                        node.children[ci].keys.append(kp)
-                        node.children[ci].values.append(vp)
-                        node.keys[ci] = node.children[ci+1].keys[0]
-                    else:
-                        node.children[ci].keys.append(node.keys[ci])
-                        node.keys[ci] = node.children[ci+1].keys.pop(0)
-                        node.children[ci].children.extend(node.children[ci+1].children[:1])
-                        node.children[ci+1].children = node.children[ci+1].children[1:]
-                    self._delete(node.children[ci], key)
+                    child.keys.insert(0, node.keys[ci-1])
+                    node.keys[ci-1] = left.keys.pop()
+                    child.children.insert(0, left.children.pop())
+            elif ci < len(node.keys) and len(node.children[ci+1].keys) > self._minkeys:
+                right = node.children[ci+1]
+                if child.is_leaf():
+                    child.keys.append(right.keys.pop(0))
+                    child.values.append(right.values.pop(0))
+                    node.keys[ci] = right.keys[0]
                 else:
-                    if ci >= 1:
-                        rnode = node.children.pop(ci)
-                        if node.children[ci-1].is_leaf():
-                            node.keys.pop(ci-1)
-                            node.children[ci-1].keys.extend(rnode.keys)
-                            node.children[ci-1].values.extend(rnode.values)
-                            node.children[ci-1].next = rnode.next
-                        else:
-                            node.children[ci-1].keys.append(node.keys.pop(ci-1))
-                            node.children[ci-1].keys.extend(rnode.keys)
-                            node.children[ci-1].children.extend(rnode.children)
-                        if node == self.root and not node.keys:
-                            self.root = node.children[ci-1]
-                        self._delete(node.children[ci-1], key)
-                    else:
-                        rnode = node.children.pop(ci+1)
-                        if node.children[ci].is_leaf():
-                            node.keys.pop(ci)
-                            node.children[ci].keys.extend(rnode.keys)
-                            node.children[ci].values.extend(rnode.values)
-                            node.children[ci].next = rnode.next
-                        else:
-                            node.children[ci].keys.append(node.keys.pop(ci))
-                            node.children[ci].keys.extend(rnode.keys)
-                            node.children[ci].children.extend(rnode.children)
-                        if node == self.root and not node.keys:
-                            self.root = node.children[ci]
-                        self._delete(node.children[ci], key)
+                    child.keys.append(node.keys[ci])
+                    node.keys[ci] = right.keys.pop(0)
+                    child.children.append(right.children.pop(0))
             else:
-                self._delete(node.children[ci], key)
-
-    def keys(self, kmin = None, kmax = None):
-        keys = []
-
-        if self.is_empty():
-            return []
-
+                # merge with the right sibling, or the left one for the last child
+                if ci == len(node.keys):
+                    ci -= 1
+                child = node.children[ci]
+                right = node.children.pop(ci+1)
+                separator = node.keys.pop(ci)
+                if child.is_leaf():
+                    child.next = right.next
+                else:
+                    child.keys.append(separator)
+                    child.children.extend(right.children)
+                child.keys.extend(right.keys)
+                child.values.extend(right.values)
+                if node is self.root and not node.keys:
+                    self.root = child
+
+        self._delete(child, key)
+
+    def _leaves(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        """yield (leaf, start, end) such that leaf.keys[start:end] are the
+        keys between kmin and kmax, in key order: one descent to the first
+        leaf, then along the next chain"""
+        node = self.root
         if kmin is None:
-            kmin = self.min()
-        if kmax is None:
-            kmax = self.max()
-
-        return self._keys(self.root, kmin, kmax, keys)
+            while node.children:
+                node = node.children[0]
+            start = 0
+        else:
+            # a separator is the lowest key of the subtree on its right
+            while node.children:
+                node = node.children[bisect.bisect_right(node.keys, kmin)]
+            if include_min:
+                start = bisect.bisect_left(node.keys, kmin)
+            else:
+                start = bisect.bisect_right(node.keys, kmin)
 
-    def _keys(self, node, kmin, kmax, keys):
-        """return [k for k in allkeys if kmin <= k <= kmax]"""
-        imin = bisect.bisect_left(node.keys, kmin)
-        imax = bisect.bisect(node.keys, kmax)
+        while node is not None:
+            keys = node.keys
+            if kmax is not None and keys and keys[-1] >= kmax:
+                if include_max:
+                    end = bisect.bisect_right(keys, kmax)
+                else:
+                    end = bisect.bisect_left(keys, kmax)
+                if end > start:
+                    yield node, start, end
+                return
 
-        if node.children:
-            for e in node.children[imin:imax+1]:
-                self._keys(e, kmin, kmax, keys)
-        if node.is_leaf():
-            keys.extend(node.keys[imin:imax])
+            yield node, start, len(keys)
+            node = node.next
+            start = 0
 
+    def keys(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        keys = []
+        for node, start, end in self._leaves(kmin, kmax, include_min, include_max):
+            keys.extend(node.keys[start:end])
         return keys
 
-    def iterkeys(self, kmin = None, kmax = None):
-        if kmin is None:
-            kmin = self.min()
-        if kmax is None:
-            kmax = self.max()
-
-        return self._iterkeys(self.root, kmin, kmax)
-
-    def _iterkeys(self, node, kmin, kmax):
-        """return [k for k in allkeys if kmin <= k <= kmax]"""
-        imin = bisect.bisect_left(node.keys, kmin)
-        imax = bisect.bisect(node.keys, kmax)
+    def iterkeys(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        for node, start, end in self._leaves(kmin, kmax, include_min, include_max):
+            for key in node.keys[start:end]:
+                yield key
 
-        if node.children:
-            for e in node.children[imin:imax+1]:
-                for k in self._iterkeys(e, kmin, kmax):
-                    yield k
-        if node.is_leaf():
-            for i in xrange(imin, imax):
-                yield node.keys[i]
-
-    def values(self, kmin = None, kmax = None):
+    def values(self, kmin = None, kmax = None, include_min = True, include_max = True):
         values = []
-
-        if self.is_empty():
-            return []
-
-        if kmin is None:
-            kmin = self.min()
-        if kmax is None:
-            kmax = self.max()
-
-        return self._values(self.root, kmin, kmax, values)
-
-    def _values(self, node, kmin, kmax, values):
-        """return [v for k in allkeys if kmin <= k <= kmax]"""
-        imin = bisect.bisect_left(node.keys, kmin)
-        imax = bisect.bisect(node.keys, kmax)
-
-        if node.children:
-            for e in node.children[imin:imax+1]:
-                self._values(e, kmin, kmax, values)
-        if node.is_leaf():
-            values.extend(node.values[imin:imax])
-
+        for node, start, end in self._leaves(kmin, kmax, include_min, include_max):
+            values.extend(node.values[start:end])
         return values
 
-    def itervalues(self, kmin = None, kmax = None):
-        if kmin is None:
-            kmin = self.min()
-        if kmax is None:
-            kmax = self.max()
-
-        return self._itervalues(self.root, kmin, kmax)
-
-    def _itervalues(self, node, kmin, kmax):
-        """return [k for k in allkeys if kmin <= k <= kmax]"""
-        imin = bisect.bisect_left(node.keys, kmin)
-        imax = bisect.bisect(node.keys, kmax)
-
-        if node.children:
-            for e in node.children[imin:imax+1]:
-                for v in self._itervalues(e, kmin, kmax):
-                    yield v
-        if node.is_leaf():
-            for i in xrange(imin, imax):
-                yield node.values[i]
+    def itervalues(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        for node, start, end in self._leaves(kmin, kmax, include_min, include_max):
+            for value in node.values[start:end]:
+                yield value
 
-    def items(self, kmin = None, kmax = None):
+    def items(self, kmin = None, kmax = None, include_min = True, include_max = True):
         items = []
-
-        if kmin is None:
-            kmin = self.min()
-        if kmax is None:
-            kmax = self.max()
-
-        return self._items(self.root, kmin, kmax, items)
-
-    def _items(self, node, kmin, kmax, items):
-        """return [(k,v) for k in allkeys if kmin <= k <= kmax]"""
-        imin = bisect.bisect_left(node.keys, kmin)
-        imax = bisect.bisect(node.keys, kmax)
-
-        if node.children:
-            for e in node.children[imin:imax+1]:
-                self._items(e, kmin, kmax, items)
-        if node.is_leaf():
-            items.extend(zip(node.keys[imin:imax], node.values[imin:imax]))
-
+        for node, start, end in self._leaves(kmin, kmax, include_min, include_max):
+            items.extend(zip(node.keys[start:end], node.values[start:end]))
         return items
 
-    def iteritems(self, kmin = None, kmax = None):
-        if kmin is None:
-            kmin = self.min()
-        if kmax is None:
-            kmax = self.max()
-
-        return self._iteritems(self.root, kmin, kmax)
-
-    def _iteritems(self, node, kmin, kmax):
-        """return [k for k in allkeys if kmin <= k <= kmax]"""
-        imin = bisect.bisect_left(node.keys, kmin)
-        imax = bisect.bisect(node.keys, kmax)
-
-        if node.children:
-            for e in node.children[imin:imax+1]:
-                for i in self._iteritems(e, kmin, kmax):
-                    yield i
-        if node.is_leaf():
-            for i in xrange(imin, imax):
-                yield (node.keys[i], node.values[i])
+    def iteritems(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        for node, start, end in self._leaves(kmin, kmax, include_min, include_max):
+            for item in zip(node.keys[start:end], node.values[start:end]):
+                yield item
 
     def is_empty(self):
         return self.root.is_leaf() and len(self.root.keys) == 0
@@ -422,15 +386,21 @@ class BPTree(object):
     def __setitem__(self, k, v):
         self.insert(k, v)
 
-    def __getitem__(self, k):
+    def get(self, k, default = None):
         node, i = self.search(self.root, k)
         if node:
             return node.values[i]
         else:
-            return None
+            return default
+
+    def contains(self, k):
+        return self.search(self.root, k)[0] is not None
+
+    __getitem__ = get
+    __contains__ = contains
 
-    #def __delitem__(self, k):
-    #    self._delete(self.root, k)
+    def __delitem__(self, k):
+        self._delete(self.root, k)
 
 def test_BPTree():
     b = BPTree(2)
@@ -479,6 +449,9 @@ def test_BPTree():
     print 'iteritems()         :', list(b.iteritems())
     print 'items(min, max)     :', b.items(3.4, 7.9)
     print 'iteritems(min, max) :', list(b.iteritems(3.4, 7.9))
+    print 'keys(5, 8) inclusive:', b.keys(5, 8)
+    print 'keys(5, 8) exclusive:', b.keys(5, 8, False, False)
+    print 'keys(5, None, False):', b.keys(5, None, False)
 
 #################################### END #######################################
 
@@ -0,0 +1,667 @@
+import bisect
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+
+import config
+from b_plus_tree import BPTree
+
+STUDENT_SCHEMA = "create table %s (sno char(8),sname char(16) unique,sage int,sgender char (1),score float,primary key ( sno ));"
+
+ORDERS_SCHEMA = "create table %s (orderkey int, custkey int unique,orderstatus char(1),totalprice float,clerk char(15),comments char(79) unique,primary key(orderkey));"
+
+_recorder = None
+
+
+def open_database():
+    """Point the catalog at a scratch directory and import recorder."""
+    global _recorder
+
+    if _recorder is None:
+        path = tempfile.mkdtemp(prefix = 'pyminisql-bench-') + '/'
+        config.table_path = path
+        config.table_file = path + 'catalog'
+        config.index_file = path + 'index'
+        config.log_file = path + 'wal'
+
+        import recorder
+        _recorder = recorder
+
+    return _recorder
+
+
+def student_rows(count):
+    snos = random.sample(xrange(10 ** 8), count)
+    for sno in snos:
+        yield ['%08d' % sno,
+               ''.join([random.choice(string.letters) for i in xrange(16)]),
+               random.randint(18, 30),
+               random.choice(['M', 'F']),
+               random.randrange(0, 100)]
+
+
+def order_rows(count):
+    keys = random.sample(xrange(10 ** 7), count)
+    customers = random.sample(xrange(10 ** 7), count)
+    for i in xrange(count):
+        yield [keys[i],
+               customers[i],
+               random.choice(['O', 'F', 'P']),
+               round(random.uniform(1000, 500000), 2),
+               'Clerk#%09d' % random.randint(0, 5000),
+               '%d %s' % (i, ''.join([random.choice(string.letters) for j in xrange(40)]))]
+
+
+def sql_value(value):
+    if isinstance(value, basestring):
+        return "'%s'" % value.replace("'", "''")
+    return repr(value)
+
+
+def create_table(schema, table_name, rows):
+    recorder = open_database()
+    import api
+
+    api.do_query(schema % table_name)
+    recorder.insert_records(table_name, list(rows))
+    recorder.update_catalog_file()
+    return recorder
+
+
+def create_student_table(table_name, count):
+    return create_table(STUDENT_SCHEMA, table_name, student_rows(count))
+
+
+def create_orders_table(table_name, count):
+    return create_table(ORDERS_SCHEMA, table_name, order_rows(count))
+
+
+def time_queries(recorder, title, queries, repeat = 3):
+    """Best of repeat runs for each (label, table, columns, conditions)."""
+    print title
+    for label, table_name, columns, conditions in queries:
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            rows = recorder.select_record(table_name, list(columns), conditions)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '  %-45s %8.3f s  (%d rows)' % (label, best, len(rows))
+
+
+def bench_bptree_insert(sizes = (10 ** 4, 10 ** 5, 10 ** 6), window = 10000):
+    """Per-insert cost measured at increasing tree sizes; it should grow
+    logarithmically, not linearly, with the number of keys."""
+
+    print 'BPTree.insert (degree 32), %d inserts timed per size' % window
+
+    tree = BPTree(32)
+    keys = random.sample(xrange(sizes[-1] * 4), sizes[-1] + window)
+    inserted = 0
+
+    for size in sizes:
+        while inserted < size:
+            tree.insert(keys[inserted], inserted)
+            inserted += 1
+
+        start = time.time()
+        for i in xrange(inserted, inserted + window):
+            tree.insert(keys[i], i)
+        elapsed = time.time() - start
+
+        # keep the measured keys so the next size starts from a larger tree
+        inserted += window
+
+        print '  %10d keys: %8.3f us/insert' % (size, elapsed / window * 1e6)
+
+        # the unique-constraint check goes through the same single descent
+        start = time.time()
+        for i in xrange(window):
+            tree.contains(keys[i])
+        elapsed = time.time() - start
+        print '  %10d keys: %8.3f us/contains' % (size, elapsed / window * 1e6)
+
+
+def bench_range_scan(count = 100000, widths = (0.001, 0.01, 0.1, 0.5), repeat = 3):
+    """Range scans of increasing width: along the leaf chain against the
+    former recursive descent into every overlapping subtree, then selects
+    with > and < on an indexed column, which no longer read the
+    complement of their range."""
+
+    def descend(node, kmin, kmax, items):
+        imin = bisect.bisect_left(node.keys, kmin)
+        imax = bisect.bisect(node.keys, kmax)
+        if node.children:
+            for child in node.children[imin:imax + 1]:
+                descend(child, kmin, kmax, items)
+        else:
+            items.extend(zip(node.keys[imin:imax], node.values[imin:imax]))
+        return items
+
+    tree = BPTree.bulk_load([(i * 2, i) for i in xrange(count)], 32, presorted = True)
+
+    print 'BPTree range scans over %d keys (degree 32)' % count
+
+    for width in widths:
+        span = int(count * width)
+        low = random.randint(0, count - span) * 2
+        high = low + span * 2
+
+        for method, scan in [('subtree descent', lambda: descend(tree.root, low, high, [])),
+                             ('leaf chain', lambda: tree.items(low, high))]:
+            best = None
+            for i in xrange(repeat):
+                start = time.time()
+                items = scan()
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print '  %5.1f%% %-20s %8.3f ms  (%d keys)' % (width * 100, method, best * 1000, len(items))
+
+    recorder = create_student_table('bench_range_scan', count)
+    keys = recorder.table_dict['bench_range_scan']['primary_index'].keys()
+
+    queries = []
+    for width in widths:
+        span = max(int(count * width), 1)
+        queries.append(('sno > top %.1f%%' % (width * 100), 'bench_range_scan', ['*'],
+                        [{'left': 'sno', 'op': '>', 'right': keys[-span - 1]}]))
+        queries.append(('sno < bottom %.1f%%' % (width * 100), 'bench_range_scan', ['*'],
+                        [{'left': 'sno', 'op': '<', 'right': keys[span]}]))
+
+    time_queries(recorder, 'Exclusive range selects over %d students' % count, queries, repeat)
+
+    recorder.delete_table_file('bench_range_scan')
+
+
+def bench_aggregate(count = 100000, repeat = 3):
+    """Aggregate statements against pulling every row into the client."""
+    recorder = open_database()
+    import api
+
+    create_student_table('bench_aggregate', count)
+
+    def client_count():
+        return len(api.execute('select sno from bench_aggregate;').fetchall())
+
+    def client_max():
+        return max([x['sno'] for x in api.execute('select sno from bench_aggregate;')])
+
+    queries = [
+        ('count(*), rows fetched', client_count),
+        ('count(*)', lambda: api.execute('select count(*) from bench_aggregate;').fetchall()),
+        ('max(sno), rows fetched', client_max),
+        ('max(sno) from the primary index', lambda: api.execute('select max(sno) from bench_aggregate;').fetchall()),
+        ('avg(score) where sage > 20',
+         lambda: api.execute('select avg(score) from bench_aggregate where sage > 20;').fetchall()),
+        ('avg(score) group by sgender',
+         lambda: api.execute('select sgender, avg(score) from bench_aggregate group by sgender;').fetchall()),
+    ]
+
+    print 'Aggregates over %d students' % count
+
+    for label, query in queries:
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            query()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '  %-45s %8.3f s' % (label, best)
+
+    recorder.delete_table_file('bench_aggregate')
+
+
+def bench_buffer_pool(count = 20000, lookups = 20000, sizes = (16, 256, 4096)):
+    """Hit ratio of random point selects for a few pool sizes (in pages)."""
+    import buffer
+
+    recorder = create_student_table('bench_pool', count)
+    keys = recorder.table_dict['bench_pool']['primary_index'].keys()
+    probes = [random.choice(keys) for i in xrange(lookups)]
+
+    print 'Buffer pool, %d point selects over %d rows' % (lookups, count)
+
+    for size in sizes:
+        recorder.update_catalog_file()
+        buffer.buffer_pool = buffer.BufferPool(size * buffer.PAGE_SIZE)
+
+        start = time.time()
+        for key in probes:
+            recorder.select_record('bench_pool', ['*'],
+                                   [{'left': 'sno', 'op': '=', 'right': key}])
+        elapsed = time.time() - start
+
+        stats = buffer.buffer_pool.stats()
+        print '  %5d pages: %8.3f us/select, hits %d, misses %d, evictions %d' % (
+            size, elapsed / lookups * 1e6, stats['hits'], stats['misses'], stats['evictions'])
+
+    recorder.delete_table_file('bench_pool')
+
+
+def bench_projection(count = 50000):
+    """Projection pushdown: decode one column versus all of them. The
+    column is not indexed, an indexed one would be read from its index."""
+    recorder = create_orders_table('bench_projection', count)
+
+    time_queries(recorder, 'Projection over %d orders' % count, [
+        ('select totalprice from orders', 'bench_projection', ['totalprice'], None),
+        ('select * from orders', 'bench_projection', ['*'], None),
+    ])
+
+    recorder.delete_table_file('bench_projection')
+
+
+def bench_multi_condition(count = 50000):
+    """Selects combining several indexed conditions."""
+    recorder = create_orders_table('bench_conditions', count)
+
+    keys = recorder.table_dict['bench_conditions']['primary_index'].keys()
+    low, high = keys[count // 10], keys[count * 9 // 10]
+    customers = recorder.table_dict['bench_conditions']['indexes']['custkey'].keys()
+    middle = customers[count // 2]
+
+    def condition(left, op, right):
+        return {'left': left, 'op': op, 'right': right}
+
+    time_queries(recorder, 'Multi-condition selects over %d orders' % count, [
+        ('orderkey >= low and orderkey <= high', 'bench_conditions', ['orderkey'],
+         [condition('orderkey', '>=', low), condition('orderkey', '<=', high)]),
+        ('orderkey >= low and custkey >= middle', 'bench_conditions', ['orderkey'],
+         [condition('orderkey', '>=', low), condition('custkey', '>=', middle)]),
+        ('orderkey >= low and custkey <> middle', 'bench_conditions', ['orderkey'],
+         [condition('orderkey', '>=', low), condition('custkey', '<>', middle)]),
+    ])
+
+    recorder.delete_table_file('bench_conditions')
+
+
+def bench_index_only(count = 100000):
+    """Selects on one indexed column, from the index alone and, with a
+    second column projected, through the table file."""
+    recorder = create_student_table('bench_index_only', count)
+    recorder.create_index('bench_index_only', 'bench_index_only_sage', 'sage')
+
+    keys = recorder.table_dict['bench_index_only']['primary_index'].keys()
+    low = keys[count // 2]
+
+    time_queries(recorder, 'Index-only scans over %d students' % count, [
+        ('sno >= middle, index only', 'bench_index_only', ['sno'],
+         [{'left': 'sno', 'op': '>=', 'right': low}]),
+        ('sno >= middle, with sage', 'bench_index_only', ['sno', 'sage'],
+         [{'left': 'sno', 'op': '>=', 'right': low}]),
+        ('sage = 20, index only', 'bench_index_only', ['sage'],
+         [{'left': 'sage', 'op': '=', 'right': 20}]),
+        ('sage = 20, with sno', 'bench_index_only', ['sage', 'sno'],
+         [{'left': 'sage', 'op': '=', 'right': 20}]),
+    ])
+
+    recorder.delete_table_file('bench_index_only')
+
+
+def bench_residual_filter(count = 50000, repeat = 3):
+    """Selects filtered on unindexed orders columns: the fused predicate
+    against a list comprehension per condition over decoded records."""
+    import operator
+    recorder = create_orders_table('bench_filter', count)
+
+    compare = {'>': operator.gt, '<': operator.lt, '=': operator.eq,
+               '<>': operator.ne, '>=': operator.ge, '<=': operator.le}
+
+    def per_condition(table_name, columns, conditions):
+        rows = recorder.read_records(table_name, None, None if '*' in columns else columns + [x['left'] for x in conditions])
+        for condition in conditions:
+            rows = [x for x in rows if compare[condition['op']](x[condition['left']], condition['right'])]
+        return rows
+
+    queries = [
+        ('totalprice > 1000 and orderstatus = O', ['orderkey'],
+         [{'left': 'totalprice', 'op': '>', 'right': 1000.0},
+          {'left': 'orderstatus', 'op': '=', 'right': 'O'}]),
+        ('totalprice > 1000 and orderstatus <> P and clerk = C', ['orderkey', 'clerk'],
+         [{'left': 'totalprice', 'op': '>', 'right': 1000.0},
+          {'left': 'orderstatus', 'op': '<>', 'right': 'P'},
+          {'left': 'clerk', 'op': '=', 'right': 'Clerk#000000042'}]),
+        ('orderkey >= 0 and totalprice < 250000', ['*'],
+         [{'left': 'orderkey', 'op': '>=', 'right': 0},
+          {'left': 'totalprice', 'op': '<', 'right': 250000.0}]),
+    ]
+
+    print 'Residual filters over %d orders' % count
+
+    for label, columns, conditions in queries:
+        for method, select in [('per condition', per_condition), ('fused', recorder.select_record)]:
+            best = None
+            for i in xrange(repeat):
+                start = time.time()
+                rows = select('bench_filter', list(columns), conditions)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print '  %-65s %8.3f s  (%d rows)' % ('%s, %s' % (label, method), best, len(rows))
+
+    recorder.delete_table_file('bench_filter')
+
+
+def bench_sequential_scan(count = 100000, repeat = 3):
+    """Full table read: sequential chunked scan versus walking the primary index."""
+    recorder = create_student_table('bench_scan', count)
+    primary_index = recorder.table_dict['bench_scan']['primary_index']
+
+    print 'Full scan of %d students' % count
+
+    for label, positions in [('sequential scan', lambda: None),
+                             ('primary index order', primary_index.positions)]:
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            rows = recorder.read_records('bench_scan', positions(), ['sno', 'score'])
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '  %-45s %8.3f s  (%d rows)' % (label, best, len(rows))
+
+    recorder.delete_table_file('bench_scan')
+
+
+def bench_mmap(count = 100000, lookups = 20000, repeat = 3):
+    """Point selects and full scans through the buffer pool and through a
+    memory-mapped table file."""
+    recorder = open_database()
+
+    print 'Table file access, %d students, %d point selects' % (count, lookups)
+
+    for label, mapped in [('buffer pool', False), ('mmap', True)]:
+        config.table_mmap = mapped
+        create_student_table('bench_mmap', count)
+        keys = recorder.table_dict['bench_mmap']['primary_index'].keys()
+        probes = [random.choice(keys) for i in xrange(lookups)]
+
+        start = time.time()
+        for key in probes:
+            recorder.select_record('bench_mmap', ['*'], [{'left': 'sno', 'op': '=', 'right': key}])
+        elapsed = time.time() - start
+        print '  %-12s point select  %8.3f us/select' % (label, elapsed / lookups * 1e6)
+
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            rows = recorder.read_records('bench_mmap', None, ['sno', 'score'])
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '  %-12s full scan     %8.3f s  (%d rows)' % (label, best, len(rows))
+
+        recorder.delete_table_file('bench_mmap')
+
+    config.table_mmap = False
+
+
+def bench_columnar(count = 200000, repeat = 3):
+    """Aggregates and a selective filter, row at a time versus on the
+    NumPy columnar engine."""
+    import columnar
+    recorder = open_database()
+
+    if not columnar.available():
+        print 'Columnar engine: NumPy is not installed, skipped'
+        return
+
+    create_student_table('bench_columnar', count)
+    over_20 = [{'left': 'sage', 'op': '>', 'right': 20}]
+
+    def row_average():
+        scores = [x['score'] for x in recorder.select_record('bench_columnar', ['score'], over_20)]
+        return sum(scores) / len(scores)
+
+    def row_group_average():
+        groups = {}
+        for row in recorder.select_record('bench_columnar', ['sgender', 'score'], None):
+            groups.setdefault(row['sgender'], []).append(row['score'])
+        return [sum(x) / len(x) for x in groups.values()]
+
+    def filtered_select():
+        return recorder.select_record('bench_columnar', ['*'],
+                                      [{'left': 'score', 'op': '=', 'right': 42}, {'left': 'sage', 'op': '<', 'right': 20}])
+
+    queries = [
+        ('avg(score) where sage > 20, rows', row_average),
+        ('avg(score) where sage > 20, columnar',
+         lambda: recorder.select_aggregate('bench_columnar', [('avg', 'score')], over_20)),
+        ('avg(score) group by sgender, rows', row_group_average),
+        ('avg(score) group by sgender, columnar',
+         lambda: recorder.select_aggregate('bench_columnar', [('avg', 'score')], None, ['sgender'])),
+        ('score = 42 and sage < 20, rows', filtered_select),
+        ('score = 42 and sage < 20, columnar', filtered_select),
+    ]
+
+    print 'Columnar engine over %d students' % count
+
+    columnar_scan = config.columnar_scan
+    for label, query in queries:
+        config.columnar_scan = not label.endswith('rows')
+        best = None
+        for i in xrange(repeat):
+            start = time.time()
+            query()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print '  %-45s %8.3f s' % (label, best)
+
+    config.columnar_scan = columnar_scan
+    recorder.delete_table_file('bench_columnar')
+
+
+def bench_group_commit(count = 5000, group_sizes = (1, 16, 64, 256)):
+    """Single-row insert statements, each committed, for a few group sizes."""
+    recorder = open_database()
+    import api
+
+    print 'Group commit, %d single-row insert statements' % count
+
+    for group_size in group_sizes:
+        config.group_commit_size = group_size
+        table_name = 'bench_commit_%d' % group_size
+        api.do_query(STUDENT_SCHEMA % table_name)
+        rows = list(student_rows(count))
+        syncs = recorder.log.syncs
+
+        start = time.time()
+        for row in rows:
+            api.execute('insert into %s values (%s);' % (table_name, ','.join(map(sql_value, row))))
+            api.flush()
+        elapsed = time.time() - start
+
+        print '  group of %4d: %8.3f us/statement, %d log syncs' % (
+            group_size, elapsed / count * 1e6, recorder.log.syncs - syncs)
+
+        recorder.delete_table_file(table_name)
+
+
+def bench_checkpoint(tables = 200, rows = 1000, statements = 200):
+    """Checkpoint after one small insert while many other tables sit idle."""
+    # unique index names are per column, so these tables have none
+    schema = "create table %s (id int, name char(16), primary key(id));"
+
+    names = ['bench_checkpoint_%d' % i for i in xrange(tables)]
+    for table_name in names:
+        recorder = create_table(schema, table_name, [[i, str(i)] for i in xrange(rows)])
+
+    print 'Checkpoint with %d tables of %d rows, one changed' % (tables, rows)
+
+    start = time.time()
+    for i in xrange(rows, rows + statements):
+        recorder.insert_records(names[0], [[i, str(i)]])
+        recorder.checkpoint()
+    elapsed = time.time() - start
+
+    print '  %8.3f ms/checkpoint, catalog file %d bytes' % (
+        elapsed / statements * 1e3, recorder.catalog_file.size)
+
+    for table_name in names:
+        recorder.delete_table_file(table_name)
+
+
+def generate_sql_inserts(table_name, count):
+    """Insert statements in the format generate_sql.py writes."""
+    for i in xrange(count):
+        data = (repr(random.randint(0, 99999999)),
+                ''.join([random.choice(string.letters) for j in xrange(16)]),
+                random.randint(18, 30),
+                random.choice(['M', 'F']),
+                random.randrange(0, 100))
+        yield "insert into %s values ('%s','%s',%d,'%s',%f);" % ((table_name,) + data)
+
+
+def bench_statement_cache(count = 20000):
+    """Parsing and running the generate_sql insert workload with and
+    without the parsed statement cache."""
+    recorder = open_database()
+    import api
+
+    statements = list(generate_sql_inserts('bench_statements', count))
+    selects = ["select sno,sname from bench_statements where sage > %d and sgender = '%s' and score <= %d;" % (
+        random.randint(18, 30), random.choice('MF'), random.randrange(0, 100)) for i in xrange(count)]
+
+    print 'Statement cache, %d generate_sql inserts' % count
+
+    for kind, sqls in [('insert', statements), ('select', selects)]:
+        start = time.time()
+        for sql in sqls:
+            api.parse_statement(sql)
+        print '  %-30s %8.3f us/statement' % (kind + ' parse, no cache', (time.time() - start) / count * 1e6)
+
+        start = time.time()
+        for sql in sqls:
+            api.prepare(sql)
+        print '  %-30s %8.3f us/statement' % (kind + ' prepare, cached', (time.time() - start) / count * 1e6)
+
+    for label, cache_size in [('execute, no cache', 0), ('execute, cached', config.statement_cache_size)]:
+        api.statement_cache = api.StatementCache(cache_size)
+        api.do_query(STUDENT_SCHEMA % 'bench_statements')
+
+        start = time.time()
+        for sql in statements:
+            # random keys may repeat
+            try:
+                api.execute(sql)
+            except Exception:
+                pass
+        elapsed = time.time() - start
+
+        print '  %-30s %8.3f us/statement  (cache hits %d)' % (
+            label, elapsed / count * 1e6, api.statement_cache.hits)
+
+        recorder.delete_table_file('bench_statements')
+
+    insert = api.prepare('insert into bench_statements values (?, ?, ?, ?, ?);')
+    api.do_query(STUDENT_SCHEMA % 'bench_statements')
+    rows = [('%08d' % i, 'name%d' % i, 20, 'M', 60.5) for i in xrange(count)]
+
+    start = time.time()
+    for row in rows:
+        insert.execute(*row)
+    print '  %-30s %8.3f us/statement' % ('prepared with parameters', (time.time() - start) / count * 1e6)
+
+    recorder.delete_table_file('bench_statements')
+
+
+def bench_execfile(count = 50000, batch_sizes = (1, 100, 1000)):
+    """Quiet execfile of a generate_sql insert script for a few insert
+    batch sizes."""
+    recorder = open_database()
+    import api
+    import interpreter
+
+    path = config.table_path + 'bench_script.sql'
+    script = open(path, 'w')
+    script.write(STUDENT_SCHEMA % 'bench_script' + '\n')
+    for sql in generate_sql_inserts('bench_script', count):
+        script.write(sql + '\n')
+    script.close()
+
+    print 'execfile, %d generate_sql inserts, %.1f MB' % (count, os.path.getsize(path) / 1048576.0)
+
+    for batch_size in batch_sizes:
+        config.script_batch_size = batch_size
+
+        start = time.time()
+        statements, errors = interpreter.exec_file(path, True)
+        elapsed = time.time() - start
+
+        print '  batch of %4d: %8.3f us/statement, %d errors' % (
+            batch_size, elapsed / statements * 1e6, errors)
+
+        recorder.delete_table_file('bench_script')
+
+    os.remove(path)
+
+
+STARTUP_SCRIPT = """
+import resource, sys, time
+sys.path.insert(0, %r)
+import config
+config.table_path = %r
+config.table_file = config.table_path + 'catalog'
+config.index_file = config.table_path + 'index'
+config.log_file = config.table_path + 'wal'
+start = time.time()
+import recorder
+opened = time.time()
+recorder.select_record('bench_startup_0', ['*'], None)
+queried = time.time()
+recorder.table_dict.values()
+print opened - start, queried - opened, time.time() - queried, \\
+    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+"""
+
+
+def bench_startup(tables = 500, rows = 200):
+    """Time to import recorder, run a first query and, for comparison, to
+    decode every table, each in a fresh interpreter."""
+    recorder = open_database()
+
+    schema = "create table %s (id int, name char(16), primary key(id));"
+    for i in xrange(tables):
+        table_name = 'bench_startup_%d' % i
+        create_table(schema, table_name, [[j, str(j)] for j in xrange(rows)])
+        recorder.create_index(table_name, 'bench_startup_index_%d' % i, 'name')
+    recorder.checkpoint()
+
+    script = STARTUP_SCRIPT % (os.path.dirname(os.path.abspath(__file__)), config.table_path)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    opened, queried, decoded, rss = output.split()
+
+    print 'Startup with %d tables of %d rows, two indexes each' % (tables, rows)
+    print '  import recorder           %8.3f s' % float(opened)
+    print '  first query               %8.3f s' % float(queried)
+    print '  decode every table        %8.3f s' % float(decoded)
+    print '  peak RSS                  %8d KB' % int(rss)
+
+    for i in xrange(tables):
+        recorder.delete_table_file('bench_startup_%d' % i)
+
+
+if __name__ == '__main__':
+    benchmarks = {
+        'aggregate': bench_aggregate,
+        'bptree_insert': bench_bptree_insert,
+        'group_commit': bench_group_commit,
+        'buffer_pool': bench_buffer_pool,
+        'checkpoint': bench_checkpoint,
+        'columnar': bench_columnar,
+        'execfile': bench_execfile,
+        'projection': bench_projection,
+        'range_scan': bench_range_scan,
+        'residual_filter': bench_residual_filter,
+        'index_only': bench_index_only,
+        'mmap': bench_mmap,
+        'multi_condition': bench_multi_condition,
+        'sequential_scan': bench_sequential_scan,
+        'startup': bench_startup,
+        'statement_cache': bench_statement_cache,
+    }
+
+    names = sys.argv[1:] or sorted(benchmarks.keys())
+    for name in names:
+        benchmarks[name]()
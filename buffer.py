@@ -1,46 +1,298 @@
 from b_plus_tree import *
+import config
+import mmap
 import os
+import time
+
+PAGE_SIZE = 4096
 
 opened_file_dict = {}
 
+# called before any dirty page is written, so the log describing a change
+# always reaches the disk before the change itself
+before_write_back = None
+
 def is_file_opened(path):
     return path in opened_file_dict.keys()
 
 
-def get_file_object(path):
+def get_file_object(path, mapped = False):
     if is_file_opened(path):
         return opened_file_dict[path]
+    elif mapped:
+        return MappedFile(path)
     else:
         return CachedFile(path)
 
 
-class CachedFile(object):
+def flush_all(sync = False):
+    for file_object in opened_file_dict.values():
+        file_object.flush(sync)
+
+
+class Frame(object):
+
+    __slots__ = ('file', 'page_no', 'data', 'pin_count', 'dirty', 'referenced')
+
+    def __init__(self):
+        self.file = None
+        self.page_no = None
+        self.data = None
+        self.pin_count = 0
+        self.dirty = False
+        self.referenced = False
+
+
+class BufferPool(object):
+    """Fixed-size pages of every open file, shared under one memory budget.
+
+    Pages are pinned while in use, written back only when dirty, and
+    replaced with the clock algorithm once the budget is used up."""
+
+    def __init__(self, size):
+        self.capacity = max(size // PAGE_SIZE, 1)
+        self.frames = []
+        self.page_table = {}
+        self.hand = 0
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'pages': len(self.page_table),
+            'pinned': len([x for x in self.frames if x.pin_count]),
+            'dirty': len([x for x in self.frames if x.dirty]),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'writebacks': self.writebacks,
+        }
+
+    def pin(self, file_object, page_no):
+        key = (file_object.path, page_no)
+        frame = self.page_table.get(key)
+
+        if frame is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            frame = self._victim()
+            frame.file = file_object
+            frame.page_no = page_no
+            frame.data = file_object.read_page(page_no)
+            self.page_table[key] = frame
+
+        frame.pin_count += 1
+        frame.referenced = True
+        return frame
+
+    def unpin(self, frame, dirty = False):
+        if frame.pin_count <= 0:
+            raise Exception('Page is not pinned.')
+
+        frame.pin_count -= 1
+
+        if dirty and not frame.dirty:
+            frame.dirty = True
+            frame.file.dirty_pages[frame.page_no] = frame
+
+    def write_back(self, frame):
+        if frame.dirty:
+            if before_write_back is not None:
+                before_write_back()
+            frame.file.write_page(frame.page_no, frame.data)
+            frame.dirty = False
+            del frame.file.dirty_pages[frame.page_no]
+            self.writebacks += 1
+
+    def discard(self, file_object, first_page = 0):
+        """Forget the pages of a file from first_page on without writing
+        them back."""
+        for key, frame in self.page_table.items():
+            if frame.file is file_object and frame.page_no >= first_page:
+                if frame.pin_count:
+                    raise Exception('Discarding a pinned page.')
+                del self.page_table[key]
+                file_object.dirty_pages.pop(frame.page_no, None)
+                frame.file = None
+                frame.data = None
+                frame.dirty = False
+                frame.referenced = False
+
+    def _victim(self):
+        if len(self.frames) < self.capacity:
+            frame = Frame()
+            self.frames.append(frame)
+            return frame
+
+        # every frame gets a second chance before it is replaced
+        for i in xrange(2 * len(self.frames)):
+            frame = self.frames[self.hand]
+            self.hand = (self.hand + 1) % len(self.frames)
+
+            if frame.pin_count:
+                continue
+            if frame.referenced:
+                frame.referenced = False
+                continue
+
+            if frame.file is not None:
+                self.write_back(frame)
+                del self.page_table[(frame.file.path, frame.page_no)]
+                self.evictions += 1
+            return frame
+
+        raise Exception('Buffer pool exhausted, all pages are pinned.')
+
+
+buffer_pool = BufferPool(config.buffer_pool_size)
+
+
+class DiskFile(object):
+    """An open file of the database, registered in opened_file_dict.
+
+    Subclasses decide how pages are read and written; dropping those kept
+    in memory is left to _drop_pages."""
 
     def __init__(self,file):
-        self.raw_file = open(file,'a+b')
-        self.deleted = False
-        self.path = file
 
         if is_file_opened(file):
             raise Exception('Duplicate file opening.')
 
+        # 'a' mode would force every write to the end of file, pages are
+        # rewritten in place so open for update and create when missing
+        if not os.path.isfile(file):
+            open(file,'wb').close()
+
+        self.raw_file = open(file,'r+b')
+        self.deleted = False
+        self.path = file
+
+        # logical size, including data still sitting in dirty pages
+        self.size = os.fstat(self.raw_file.fileno()).st_size
+        self.synced = True
+
         opened_file_dict[self.path] = self
 
     def __del__(self):
         if not self.deleted:
             self.raw_file.close()
 
+    def _drop_pages(self, first_page = 0):
+        """forget what is kept in memory from first_page on, unwritten"""
+        pass
+
     def delete(self):
+        self._drop_pages()
+        self.raw_file.close()
         os.remove(self.path)
         self.deleted = True
+        del opened_file_dict[self.path]
+
+    def close(self):
+        self.flush()
+        self._drop_pages()
+        self.raw_file.close()
+        # unusable from now on, like a deleted file
+        self.deleted = True
+        del opened_file_dict[self.path]
+
+    def truncate(self, size = 0):
+
+        if self.deleted:
+            raise Exception("File already deleted.")
+
+        # the page holding the new end of file may stay, anything past the
+        # logical size is never written back
+        self._drop_pages((size + PAGE_SIZE - 1) // PAGE_SIZE)
+        self.raw_file.seek(size)
+        self.raw_file.truncate()
+        self.synced = False
+        self.size = size
+
+    def replace(self, path):
+        """Take over the content of the file at path, renamed in one step."""
+
+        if self.deleted:
+            raise Exception("File already deleted.")
+
+        self._drop_pages()
+        self.raw_file.close()
+        os.rename(path, self.path)
+        self.raw_file = open(self.path, 'r+b')
+        self.size = os.fstat(self.raw_file.fileno()).st_size
+
+
+class CachedFile(DiskFile):
+
+    def __init__(self,file):
+        DiskFile.__init__(self, file)
+        self.dirty_pages = {}
+        self.last_flush = time.time()
+
+    def _drop_pages(self, first_page = 0):
+        buffer_pool.discard(self, first_page)
+
+    def flush(self, sync = False):
+
+        if self.deleted:
+            raise Exception("File already deleted.")
+
+        for page_no in sorted(self.dirty_pages.keys()):
+            buffer_pool.write_back(self.dirty_pages[page_no])
+
+        self.raw_file.flush()
+        if sync and not self.synced:
+            os.fsync(self.raw_file.fileno())
+            self.synced = True
+        self.last_flush = time.time()
+
+    def read_page(self, page_no):
+        self.raw_file.seek(page_no * PAGE_SIZE)
+        data = bytearray(self.raw_file.read(PAGE_SIZE))
+        if len(data) < PAGE_SIZE:
+            data.extend('\x00' * (PAGE_SIZE - len(data)))
+        return data
+
+    def write_page(self, page_no, data):
+        # never write the zero padding past the logical end of file
+        start = page_no * PAGE_SIZE
+        length = min(PAGE_SIZE, self.size - start)
+        if length > 0:
+            self.raw_file.seek(start)
+            self.raw_file.write(data[:length])
+            self.synced = False
+
+    def view(self, offset, size):
+        """(buffer, start) with size bytes at start, for struct.unpack_from"""
+        return self.read(offset, size), 0
 
     def read(self,offset,size):
 
         if self.deleted:
             raise Exception("File already deleted.")
 
-        self.raw_file.seek(offset)
-        return self.raw_file.read(size)
+        end = min(offset + size, self.size)
+        chunks = []
+
+        while offset < end:
+            page_no, start = divmod(offset, PAGE_SIZE)
+            length = min(PAGE_SIZE - start, end - offset)
+
+            frame = buffer_pool.pin(self, page_no)
+            chunks.append(str(frame.data[start:start + length]))
+            buffer_pool.unpin(frame)
+
+            offset += length
+
+        return ''.join(chunks)
 
     def write(self,data,offset=None):
 
@@ -48,13 +300,110 @@ class CachedFile(object):
            raise Exception("File already deleted.")
 
         if offset is None:
-            self.raw_file.seek(0,2)
-        else:
-            self.raw_file.seek(offset)
+            offset = self.size
+
+        start_pos = offset
+        self.size = max(self.size, offset + len(data))
+
+        written = 0
+        while written < len(data):
+            page_no, start = divmod(offset + written, PAGE_SIZE)
+            length = min(PAGE_SIZE - start, len(data) - written)
+
+            frame = buffer_pool.pin(self, page_no)
+            frame.data[start:start + length] = data[written:written + length]
+            buffer_pool.unpin(frame, True)
+
+            # an appended page that just filled up will not change again
+            if start + length == PAGE_SIZE and offset + written + length == self.size:
+                buffer_pool.write_back(frame)
+
+            written += length
+
+        # the rest waits for an explicit flush or for a threshold
+        if len(self.dirty_pages) >= config.write_back_pages or \
+                time.time() - self.last_flush >= config.write_back_interval:
+            self.flush()
+
+        return start_pos
+
+
+class MappedFile(DiskFile):
+    """A file read through a shared memory map instead of the buffer pool.
+
+    view() hands out the map itself, so records are decoded in place with
+    no syscall and no copy; the map is renewed on the first read past its
+    end after the file grew. Writes go straight to the file, which the map
+    sees through the page cache, once before_write_back has forced the log.
+    That costs a log sync per written statement, so the mode suits tables
+    that are mostly read."""
 
+    def __init__(self,file):
+        DiskFile.__init__(self, file)
+        self.map = None
+        self.mapped_size = 0
+
+    def _drop_pages(self, first_page = 0):
+        # a mapped page past the end of file can't be touched any more
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            self.mapped_size = 0
+
+    def _remap(self):
+        # a scan may still hold the old map, it is closed once dropped
+        self.map = None
+        self.mapped_size = 0
+        if self.size:
+            self.map = mmap.mmap(self.raw_file.fileno(), self.size, access = mmap.ACCESS_READ)
+            self.mapped_size = self.size
+
+    def flush(self, sync = False):
+
+        if self.deleted:
+            raise Exception("File already deleted.")
+
+        if sync and not self.synced:
+            os.fsync(self.raw_file.fileno())
+            self.synced = True
+
+    def view(self, offset, size):
+        """(buffer, start) with size bytes at start, for struct.unpack_from"""
+
+        if self.deleted:
+            raise Exception("File already deleted.")
+
+        if offset + size > self.mapped_size:
+            self._remap()
+            if self.map is None:
+                return '', 0
+
+        return self.map, offset
 
-        start_pos = self.raw_file.tell()
+    def read(self,offset,size):
+        end = min(offset + size, self.size)
+        if end <= offset:
+            return ''
+
+        data, start = self.view(offset, end - offset)
+        return data[start:start + end - offset]
+
+    def write(self,data,offset=None):
+
+        if self.deleted:
+           raise Exception("File already deleted.")
+
+        if offset is None:
+            offset = self.size
+
+        if before_write_back is not None:
+            before_write_back()
+
+        self.raw_file.seek(offset)
         self.raw_file.write(data)
         self.raw_file.flush()
 
-        return start_pos
+        self.size = max(self.size, offset + len(data))
+        self.synced = False
+
+        return offset
@@ -0,0 +1,211 @@
+#
+# Catalog file.
+#
+# The catalog is an append-only file of framed records: a table entry for
+# each table whose metadata changed, a drop record for dropped tables and
+# the index names when they change. A checkpoint record commits everything
+# appended before it; records after the last one are a torn write and are
+# cut off on load. Once the file has grown well past its live content it
+# is rewritten in full to a temporary file that is renamed over the old one.
+#
+# Loading only reads the frame headers and table names; table entries stay
+# in the file until read_entry() asks for one.
+#
+
+import os
+import pickle
+import struct
+import zlib
+
+MAGIC = 'PMSCAT01'
+VERSION = 1
+HEADER = struct.Struct('<8sI')      # magic, version
+FRAME = struct.Struct('<IIB')       # payload length, crc32, kind
+NAME = struct.Struct('<H')          # table name length, in front of an entry
+LSN = struct.Struct('<q')
+
+TABLE = 1
+DROP = 2
+INDEXES = 3
+CHECKPOINT = 4
+
+REWRITE_FACTOR = 4
+REWRITE_MINIMUM = 1024 * 1024
+
+
+def _frame(kind, payload):
+    return FRAME.pack(len(payload), zlib.crc32(payload, kind) & 0xffffffff, kind) + payload
+
+
+def _table_frame(table_name, raw_entry):
+    return _frame(TABLE, NAME.pack(len(table_name)) + table_name + raw_entry)
+
+
+class CatalogFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.live_size = 0          # size right after the last full rewrite
+
+        self.entries = {}           # table name -> (offset, length) of its entry
+        self.indexes = {}
+
+    def load(self):
+        """Returns (table names, indexes, checkpoint_lsn) as of the last
+        checkpoint."""
+        checkpoint_lsn = 0
+
+        if not os.path.isfile(self.path):
+            return [], self.indexes, checkpoint_lsn
+
+        catalog_file = open(self.path, 'rb')
+        header = catalog_file.read(HEADER.size)
+        magic, version = HEADER.unpack(header) if len(header) == HEADER.size else (None, None)
+        if magic != MAGIC:
+            catalog_file.close()
+            raise Exception('Unsupported catalog version in %s, see upgrade.py.' % self.path)
+        if version != VERSION:
+            catalog_file.close()
+            raise Exception('Unsupported catalog version %d.' % version)
+
+        pending = []
+        end = HEADER.size
+
+        while True:
+            header = catalog_file.read(FRAME.size)
+            if len(header) < FRAME.size:
+                break
+
+            length, crc, kind = FRAME.unpack(header)
+            offset = catalog_file.tell()
+            payload = catalog_file.read(length)
+            if len(payload) < length or zlib.crc32(payload, kind) & 0xffffffff != crc:
+                break
+
+            if kind != CHECKPOINT:
+                pending.append((kind, offset, payload))
+                continue
+
+            for change_kind, change_offset, change in pending:
+                if change_kind == TABLE:
+                    name_end = NAME.size + NAME.unpack_from(change)[0]
+                    self.entries[change[NAME.size:name_end]] = (change_offset + name_end, len(change) - name_end)
+                elif change_kind == DROP:
+                    self.entries.pop(change, None)
+                elif change_kind == INDEXES:
+                    self.indexes = pickle.loads(change)
+                else:
+                    raise Exception('Unexpected catalog record: %d' % change_kind)
+
+            pending = []
+            checkpoint_lsn = LSN.unpack(payload)[0]
+            end = catalog_file.tell()
+
+        catalog_file.close()
+
+        if end < os.path.getsize(self.path):
+            catalog_file = open(self.path, 'r+b')
+            catalog_file.truncate(end)
+            catalog_file.close()
+
+        self.size = end
+        self.live_size = end
+        return self.entries.keys(), self.indexes, checkpoint_lsn
+
+    def _read_raw_entry(self, table_name, catalog_file = None):
+        offset, length = self.entries[table_name]
+        opened = catalog_file is None
+        if opened:
+            catalog_file = open(self.path, 'rb')
+        catalog_file.seek(offset)
+        raw_entry = catalog_file.read(length)
+        if opened:
+            catalog_file.close()
+        return raw_entry
+
+    def read_entry(self, table_name):
+        return pickle.loads(self._read_raw_entry(table_name))
+
+    def needs_rewrite(self):
+        # an empty size means the file is missing
+        return self.size == 0 or self.size > max(REWRITE_FACTOR * self.live_size, REWRITE_MINIMUM)
+
+    def save(self, tables, dropped, indexes, checkpoint_lsn):
+        """Commit the entries of changed tables, the names of dropped ones
+        and, unless None, the new index names."""
+        if indexes is not None:
+            self.indexes = indexes
+
+        raw_entries = dict([(table_name, pickle.dumps(entry, 2))
+                            for table_name, entry in tables.iteritems()])
+
+        if self.needs_rewrite():
+            self._rewrite(raw_entries, dropped, checkpoint_lsn)
+        else:
+            self._append(raw_entries, dropped, indexes, checkpoint_lsn)
+
+    def _append(self, raw_entries, dropped, indexes, checkpoint_lsn):
+        data = [_frame(DROP, table_name) for table_name in dropped]
+
+        offset = self.size + sum([len(x) for x in data])
+        offsets = {}
+        for table_name, raw_entry in raw_entries.iteritems():
+            frame = _table_frame(table_name, raw_entry)
+            offsets[table_name] = (offset + len(frame) - len(raw_entry), len(raw_entry))
+            offset += len(frame)
+            data.append(frame)
+
+        if indexes is not None:
+            data.append(_frame(INDEXES, pickle.dumps(indexes, 2)))
+        data.append(_frame(CHECKPOINT, LSN.pack(checkpoint_lsn)))
+        data = ''.join(data)
+
+        catalog_file = open(self.path, 'ab')
+        catalog_file.write(data)
+        catalog_file.flush()
+        os.fsync(catalog_file.fileno())
+        catalog_file.close()
+
+        for table_name in dropped:
+            self.entries.pop(table_name, None)
+        self.entries.update(offsets)
+        self.size += len(data)
+
+    def _rewrite(self, raw_entries, dropped, checkpoint_lsn):
+        # unchanged entries are copied over without being decoded
+        names = set(self.entries.keys()).difference(dropped).union(raw_entries.keys())
+
+        old_file = open(self.path, 'rb') if self.entries else None
+
+        data = [HEADER.pack(MAGIC, VERSION)]
+        offset = HEADER.size
+        offsets = {}
+        for table_name in names:
+            raw_entry = raw_entries.get(table_name)
+            if raw_entry is None:
+                raw_entry = self._read_raw_entry(table_name, old_file)
+
+            frame = _table_frame(table_name, raw_entry)
+            offsets[table_name] = (offset + len(frame) - len(raw_entry), len(raw_entry))
+            offset += len(frame)
+            data.append(frame)
+
+        if old_file is not None:
+            old_file.close()
+
+        data.append(_frame(INDEXES, pickle.dumps(self.indexes, 2)))
+        data.append(_frame(CHECKPOINT, LSN.pack(checkpoint_lsn)))
+        data = ''.join(data)
+
+        temp_path = self.path + '.tmp'
+        catalog_file = open(temp_path, 'wb')
+        catalog_file.write(data)
+        catalog_file.flush()
+        os.fsync(catalog_file.fileno())
+        catalog_file.close()
+        os.rename(temp_path, self.path)
+
+        self.entries = offsets
+        self.size = len(data)
+        self.live_size = len(data)
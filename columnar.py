@@ -0,0 +1,161 @@
+#
+# Columnar execution.
+#
+# Records are fixed-width structs, so a table file is a packed array of
+# them. Viewed as a NumPy structured array, conditions become boolean
+# masks and aggregates whole-column reductions, with no Python work per
+# record. NumPy is optional: without it available() is False and the
+# recorder stays with its row at a time engine.
+#
+
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FIELD_TYPES = {'int': 'i4', 'float': 'f4'}
+STATUS_FIELD = '#_status'
+
+COMPARE_OPERATORS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+    '<>': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le
+}
+
+
+def available():
+    return numpy is not None
+
+
+def record_dtype(codec):
+    """Structured dtype with the layout of the records of codec."""
+    names = []
+    formats = []
+    offsets = []
+
+    for schema in codec.schemas:
+        if schema['type'] == 'char':
+            formats.append('S%d' % schema['length'])
+        else:
+            formats.append(FIELD_TYPES[schema['type']])
+        names.append(schema['name'])
+        offsets.append(codec.offsets[schema['name']])
+
+    names.append(STATUS_FIELD)
+    formats.append('u1')
+    offsets.append(codec.status_offset)
+
+    return numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': codec.size})
+
+
+def table_array(codec, file_object):
+    """Every record slot of a table file, free ones included. The array
+    shares the memory of a mapped file and is copied out of the buffer
+    pool otherwise; either way it must not outlive the next write."""
+    count = file_object.size // codec.size
+    if count == 0:
+        return numpy.zeros(0, record_dtype(codec))
+
+    data, start = file_object.view(0, count * codec.size)
+    return numpy.frombuffer(data, record_dtype(codec), count, start)
+
+
+def column(array, name):
+    # floats are stored in single precision but compared and summed in
+    # double by the row engine, do the same
+    values = array[name]
+    if values.dtype.kind == 'f':
+        values = values.astype(numpy.float64)
+    return values
+
+
+def mask(array, filters):
+    """Boolean mask of the live records passing every (column, op, value)
+    filter."""
+    selected = array[STATUS_FIELD] == 1
+    for name, op, value in filters:
+        selected &= COMPARE_OPERATORS[op](column(array, name), value)
+    return selected
+
+
+def positions(selected, record_size):
+    """File positions of the selected records, in file order."""
+    return (numpy.flatnonzero(selected) * record_size).tolist()
+
+
+def aggregate_label(function, name):
+    return '%s(%s)' % (function, name)
+
+
+def _reduce(function, values, starts, ends):
+    """function over values[starts[i]:ends[i]] for every group i"""
+    counts = ends - starts
+
+    if function == 'count':
+        return counts.tolist()
+
+    if values.dtype.kind == 'S':
+        # no ufunc reduces byte strings, they are few enough per group
+        values = values.tolist()
+        reduce_group = min if function == 'min' else max
+        return [reduce_group(values[start:end]) for start, end in zip(starts, ends)]
+
+    if function == 'min':
+        return numpy.minimum.reduceat(values, starts).tolist()
+    if function == 'max':
+        return numpy.maximum.reduceat(values, starts).tolist()
+
+    accumulator = numpy.float64 if values.dtype.kind == 'f' else numpy.int64
+    sums = numpy.add.reduceat(values.astype(accumulator), starts)
+
+    if function == 'sum':
+        return sums.tolist()
+    return (sums / counts.astype(numpy.float64)).tolist()
+
+
+def aggregate(array, selected, aggregates, group_by = None):
+    """Rows of aggregates, (function, column) pairs with column '*' for
+    count(*), over the selected records.
+
+    Without group_by there is one row, where every aggregate but count is
+    None for an empty selection. With it there is one row per distinct
+    combination of the group_by columns, which the row holds as well,
+    ordered by them."""
+    array = array[selected]
+    group_by = group_by or []
+
+    if not len(array):
+        if group_by:
+            return []
+        return [dict([(aggregate_label(function, name), 0 if function == 'count' else None)
+                      for function, name in aggregates])]
+
+    if group_by:
+        keys = [array[name] for name in group_by]
+        order = numpy.lexsort(keys[::-1])
+        array = array[order]
+
+        boundary = numpy.zeros(len(array), bool)
+        boundary[0] = True
+        for name in group_by:
+            values = array[name]
+            boundary[1:] |= values[1:] != values[:-1]
+        starts = numpy.flatnonzero(boundary)
+    else:
+        starts = numpy.zeros(1, numpy.intp)
+
+    ends = numpy.append(starts[1:], len(array))
+
+    result_columns = []
+    for name in group_by:
+        result_columns.append((name, column(array, name)[starts].tolist()))
+    for function, name in aggregates:
+        values = column(array, name) if name != '*' else None
+        result_columns.append((aggregate_label(function, name), _reduce(function, values, starts, ends)))
+
+    return [dict([(label, values[i]) for label, values in result_columns]) for i in xrange(len(starts))]
@@ -1,3 +1,19 @@
 table_path = '/home/coxious/PycharmProjects/PyMiniSQL/data/test/'
 table_file = '/home/coxious/PycharmProjects/PyMiniSQL/data/test/catalog'
 index_file = '/home/coxious/PycharmProjects/PyMiniSQL/data/test/index'
+log_file = '/home/coxious/PycharmProjects/PyMiniSQL/data/test/wal'
+index_fill_factor = 0.9
+buffer_pool_size = 16 * 1024 * 1024
+write_back_pages = 256
+write_back_interval = 1.0
+group_commit_size = 64
+group_commit_interval = 0.05
+checkpoint_log_size = 64 * 1024 * 1024
+table_cache_size = 64
+statement_cache_size = 256
+script_chunk_size = 1024 * 1024
+script_batch_size = 1000
+script_commit_statements = 10000
+script_progress_interval = 5.0
+table_mmap = False
+columnar_scan = False
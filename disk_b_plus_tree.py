@@ -0,0 +1,518 @@
+#
+# A B+ tree whose nodes live in fixed-size pages of an index file.
+#
+# Every leaf entry is a (key, position) pair, so a key with many positions
+# simply spans several entries and no page ever has to hold an unbounded
+# posting list. Pages are read through the buffer layer, decoded nodes are
+# cached, and only the pages that were modified are written back on flush.
+#
+# Deletion is lazy: entries are removed from their leaf but nodes are never
+# merged, so separators stay valid and empty leaves are skipped while
+# walking the leaf chain. Rebuilding an index with bulk_load packs it again.
+#
+
+import bisect
+import itertools
+import struct
+
+import buffer
+
+MAGIC = 'PMSBPT01'
+HEADER = struct.Struct('<8sI16sqqq')     # magic, page size, key format, root, page count, entry count
+NODE_HEADER = struct.Struct('<Bhq')      # is leaf, entry count, next leaf
+POINTER = struct.Struct('<q')
+NO_PAGE = -1
+
+
+class DiskNode(object):
+
+    def __init__(self, page_id, leaf):
+        self.page_id = page_id
+        self.leaf = leaf
+        self.entries = list()       # sorted (key, position) pairs
+        self.children = list()      # child page ids, internal nodes only
+        self.next = NO_PAGE
+
+    def __str__(self):
+        return '|%d:%s|' % (self.page_id, ' '.join(['{%s:%s}' % e for e in self.entries]))
+
+    __repr__ = __str__
+
+
+class DiskBPTree(object):
+
+    def __init__(self, path, key_format, create = False, cache_limit = 1024):
+        self.path = path
+        self.key_format = key_format
+        self.cache_limit = cache_limit
+
+        self._entry = struct.Struct('<%sq' % key_format)
+        self._entry_child = struct.Struct('<%sqq' % key_format)
+        self._is_char = key_format.endswith('s')
+        self._char_length = int(key_format[:-1] or 1) if self._is_char else None
+        self._float = struct.Struct('<f') if key_format == 'f' else None
+
+        self._leaf_capacity = (buffer.PAGE_SIZE - NODE_HEADER.size) // self._entry.size
+        self._internal_capacity = (buffer.PAGE_SIZE - NODE_HEADER.size - POINTER.size) // self._entry_child.size
+
+        if self._internal_capacity < 3:
+            raise Exception('Index key %s is too long for a page.' % key_format)
+
+        self._cache = {}
+        self._dirty = {}
+        self._header_dirty = False
+
+        self.file = buffer.get_file_object(path)
+
+        if create:
+            self.file.truncate()
+
+        if create or not self.file.read(0, HEADER.size):
+            self.page_count = 1
+            self.count = 0
+            self.root_id = self._allocate(True).page_id
+            self.flush()
+        else:
+            self._read_header()
+
+    def __getstate__(self):
+        # the catalog only keeps where the tree lives; nodes stay in the file
+        return {'path': self.path, 'key_format': self.key_format}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['key_format'])
+
+    @classmethod
+    def bulk_load(cls, path, key_format, pairs, fill_factor = 1.0, presorted = False):
+        """Build a tree bottom-up from (key, position) pairs, writing each
+        page once. Pairs are sorted unless presorted is set."""
+        tree = cls(path, key_format, create = True)
+
+        entries = [(tree.normalize(key), value) for key, value in pairs]
+        if not presorted:
+            entries.sort()
+
+        tree._build(entries, fill_factor)
+        return tree
+
+    def _build(self, entries, fill_factor):
+
+        def chunk(items, capacity):
+            size = max(min(int(capacity * fill_factor), capacity), 1)
+            for start in xrange(0, len(items), size):
+                yield items[start:start + size]
+
+        self._cache.clear()
+        self._dirty.clear()
+        self.page_count = 1
+
+        if not entries:
+            self.root_id = self._allocate(True).page_id
+            self.count = 0
+            self.flush()
+            return
+
+        level = []
+        leaf = None
+        for group in chunk(entries, self._leaf_capacity):
+            if leaf is not None:
+                leaf.next = self.page_count
+                self._write_node(leaf)
+            leaf = DiskNode(self._next_page_id(), True)
+            leaf.entries = group
+            level.append((group[0], leaf.page_id))
+        self._write_node(leaf)
+
+        while len(level) > 1:
+            parents = []
+            # an internal node holds one more child than separators
+            for group in chunk(level, self._internal_capacity + 1):
+                node = DiskNode(self._next_page_id(), False)
+                node.children = [page_id for first, page_id in group]
+                node.entries = [first for first, page_id in group[1:]]
+                self._write_node(node)
+                parents.append((group[0][0], node.page_id))
+            level = parents
+
+        self.root_id = level[0][1]
+        self.count = len(entries)
+        self._header_dirty = True
+        self.flush()
+
+    def _read_header(self):
+        magic, page_size, key_format, root_id, page_count, count = \
+            HEADER.unpack(self.file.read(0, HEADER.size))
+
+        if magic != MAGIC or page_size != buffer.PAGE_SIZE:
+            raise Exception('%s is not an index file.' % self.path)
+        if key_format.rstrip('\x00') != self.key_format:
+            raise Exception('Index key format mismatch in %s.' % self.path)
+
+        self.root_id = root_id
+        self.page_count = page_count
+        self.count = count
+
+    def _write_header(self):
+        data = HEADER.pack(MAGIC, buffer.PAGE_SIZE, self.key_format,
+                           self.root_id, self.page_count, self.count)
+        self.file.write(data.ljust(buffer.PAGE_SIZE, '\x00'), 0)
+        self._header_dirty = False
+
+    def _next_page_id(self):
+        page_id = self.page_count
+        self.page_count += 1
+        self._header_dirty = True
+        return page_id
+
+    def _allocate(self, leaf):
+        node = DiskNode(self._next_page_id(), leaf)
+        self._cache[node.page_id] = node
+        self._dirty[node.page_id] = node
+        return node
+
+    def _touch(self, node):
+        self._dirty[node.page_id] = node
+
+    def _node(self, page_id):
+        node = self._cache.get(page_id)
+        if node is None:
+            node = self._decode(page_id, self.file.read(page_id * buffer.PAGE_SIZE, buffer.PAGE_SIZE))
+            self._cache[page_id] = node
+        return node
+
+    def _trim(self):
+        # called between operations only, so nobody holds an evicted node.
+        # Dirty nodes are handed to the buffer layer instead of being kept:
+        # every change is logged before it reaches a node and recovery
+        # rebuilds the indexes of logged tables, so they may be written early
+        if len(self._cache) > self.cache_limit:
+            self._write_dirty()
+            self._cache = {}
+
+    def _encode(self, node):
+        data = bytearray(buffer.PAGE_SIZE)
+        NODE_HEADER.pack_into(data, 0, node.leaf, len(node.entries), node.next)
+        offset = NODE_HEADER.size
+
+        if node.leaf:
+            for key, position in node.entries:
+                self._entry.pack_into(data, offset, key, position)
+                offset += self._entry.size
+        else:
+            POINTER.pack_into(data, offset, node.children[0])
+            offset += POINTER.size
+            for (key, position), child in zip(node.entries, node.children[1:]):
+                self._entry_child.pack_into(data, offset, key, position, child)
+                offset += self._entry_child.size
+
+        return str(data)
+
+    def _decode(self, page_id, data):
+        leaf, count, next_page = NODE_HEADER.unpack_from(data, 0)
+        node = DiskNode(page_id, bool(leaf))
+        node.next = next_page
+        offset = NODE_HEADER.size
+
+        if node.leaf:
+            unpack = self._entry.unpack_from
+            size = self._entry.size
+            for i in xrange(count):
+                key, position = unpack(data, offset)
+                if self._is_char:
+                    key = key.rstrip('\x00')
+                node.entries.append((key, position))
+                offset += size
+        else:
+            unpack = self._entry_child.unpack_from
+            size = self._entry_child.size
+            node.children.append(POINTER.unpack_from(data, offset)[0])
+            offset += POINTER.size
+            for i in xrange(count):
+                key, position, child = unpack(data, offset)
+                if self._is_char:
+                    key = key.rstrip('\x00')
+                node.entries.append((key, position))
+                node.children.append(child)
+                offset += size
+
+        return node
+
+    def _write_node(self, node):
+        self.file.write(self._encode(node), node.page_id * buffer.PAGE_SIZE)
+
+    def normalize(self, key):
+        # keys are stored exactly as the record file stores the column, so
+        # a key read back from a record finds its entry
+        if self._is_char:
+            return key[:self._char_length]
+        if self._float is not None:
+            return self._float.unpack(self._float.pack(key))[0]
+        return key
+
+    def _write_dirty(self):
+        for page_id in sorted(self._dirty.keys()):
+            self._write_node(self._dirty[page_id])
+        self._dirty.clear()
+
+        if self._header_dirty:
+            self._write_header()
+
+    def flush(self):
+        self._write_dirty()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self._cache.clear()
+        self.file.close()
+
+    def drop(self):
+        self._cache.clear()
+        self._dirty.clear()
+        self.file.delete()
+
+    def _find_leaf(self, entry):
+        node = self._node(self.root_id)
+        while not node.leaf:
+            node = self._node(node.children[bisect.bisect_right(node.entries, entry)])
+        return node
+
+    def _leftmost_leaf(self):
+        node = self._node(self.root_id)
+        while not node.leaf:
+            node = self._node(node.children[0])
+        return node
+
+    def _iterentries(self, kmin = None, kmax = None, include_min = True, include_max = True, after = None):
+        """yield (key, position) for the keys between kmin and kmax along
+        the leaf chain, each bound inclusive unless told otherwise; an
+        entry handed out before as after resumes right behind it"""
+        if after is not None:
+            node = self._find_leaf(after)
+            i = bisect.bisect_right(node.entries, after)
+        elif kmin is None:
+            node = self._leftmost_leaf()
+            i = 0
+        else:
+            # bounds are compared with the stored keys as they are, only a
+            # char bound is cut to the key length
+            key = kmin
+            if self._is_char:
+                key = self.normalize(kmin)
+                if key != kmin:
+                    # no stored key reaches the cut off part of a char bound
+                    include_min = False
+            # (key,) sorts before and (key, inf) after every entry of key
+            start = (key,) if include_min else (key, float('inf'))
+            node = self._find_leaf(start)
+            i = bisect.bisect_left(node.entries, start)
+
+        if kmax is not None and self._is_char:
+            key = self.normalize(kmax)
+            if key != kmax:
+                include_max = True
+            kmax = key
+
+        while True:
+            entries = node.entries
+            while i < len(entries):
+                entry = entries[i]
+                if kmax is not None and (entry[0] > kmax or (entry[0] == kmax and not include_max)):
+                    return
+                yield entry
+                i += 1
+
+            if node.next == NO_PAGE:
+                return
+            node = self._node(node.next)
+            i = 0
+
+    def iterentries(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        """(key, position) pairs in key order; the tree must not change
+        while the iterator is in use"""
+        return self._iterentries(kmin, kmax, include_min, include_max)
+
+    def insert(self, key, value):
+        """Returns True if key was not in the tree before."""
+        entry = (self.normalize(key), value)
+
+        split, new_key = self._insert(self._node(self.root_id), entry)
+        if split is not None:
+            separator, right_id = split
+            root = self._allocate(False)
+            root.entries = [separator]
+            root.children = [self.root_id, right_id]
+            self.root_id = root.page_id
+
+        self.count += 1
+        self._header_dirty = True
+        self._trim()
+        return new_key
+
+    def _insert(self, node, entry):
+        """insert below node, returning (separator, new page) if it split,
+        or None, and whether the key is new"""
+        if node.leaf:
+            i = bisect.bisect_left(node.entries, entry)
+            node.entries.insert(i, entry)
+            self._touch(node)
+            new_key = self._only_entry_of_key(node, i)
+
+            if len(node.entries) <= self._leaf_capacity:
+                return None, new_key
+
+            right = self._allocate(True)
+            half = len(node.entries) // 2
+            right.entries = node.entries[half:]
+            node.entries = node.entries[:half]
+            right.next = node.next
+            node.next = right.page_id
+            return (right.entries[0], right.page_id), new_key
+
+        i = bisect.bisect_right(node.entries, entry)
+        split, new_key = self._insert(self._node(node.children[i]), entry)
+        if split is None:
+            return None, new_key
+
+        separator, right_id = split
+        node.entries.insert(i, separator)
+        node.children.insert(i + 1, right_id)
+        self._touch(node)
+
+        if len(node.entries) <= self._internal_capacity:
+            return None, new_key
+
+        right = self._allocate(False)
+        half = len(node.entries) // 2
+        separator = node.entries[half]
+        right.entries = node.entries[half + 1:]
+        right.children = node.children[half + 1:]
+        node.entries = node.entries[:half]
+        node.children = node.children[:half + 1]
+        return (separator, right.page_id), new_key
+
+    def _only_entry_of_key(self, leaf, i):
+        entries = leaf.entries
+        key = entries[i][0]
+        if i > 0 and entries[i - 1][0] == key:
+            return False
+        if i + 1 < len(entries) and entries[i + 1][0] == key:
+            return False
+        if 0 < i < len(entries) - 1:
+            return True
+
+        # at either end of the leaf other entries of key may be in the
+        # neighbouring leaves
+        count = 0
+        for entry in self._iterentries(key, key):
+            count += 1
+            if count > 1:
+                return False
+        return True
+
+    def insert_many(self, pairs, fill_factor = 1.0):
+        """Insert (key, position) pairs in key order; an empty tree is
+        bulk loaded instead. Returns a (key, new) pair for each, new when
+        the key was not in the tree before."""
+        entries = sorted([(self.normalize(key), value) for key, value in pairs])
+
+        if self.is_empty() and len(entries) > 1:
+            self._build(entries, fill_factor)
+            return [(key, i == 0 or entries[i - 1][0] != key) for i, (key, value) in enumerate(entries)]
+
+        return [(key, self.insert(key, value)) for key, value in entries]
+
+    def delete(self, key, value):
+        entry = (self.normalize(key), value)
+        node = self._find_leaf(entry)
+
+        i = bisect.bisect_left(node.entries, entry)
+        if i < len(node.entries) and node.entries[i] == entry:
+            node.entries.pop(i)
+            self._touch(node)
+            self.count -= 1
+            self._header_dirty = True
+
+        self._trim()
+
+    def get(self, k, default = None):
+        # a char lookup matches on the stored, possibly truncated, key; a
+        # float one is exact, as in a comparison with the record
+        if self._is_char:
+            k = self.normalize(k)
+        values = [position for key, position in self._iterentries(k, k)]
+        self._trim()
+        return values if values else default
+
+    def contains(self, k):
+        k = self.normalize(k)
+        for entry in self._iterentries(k, k):
+            return True
+        return False
+
+    __getitem__ = get
+    __contains__ = contains
+
+    def __len__(self):
+        return self.count
+
+    def is_empty(self):
+        return self.count == 0
+
+    def items(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        items = []
+        for key, position in self._iterentries(kmin, kmax, include_min, include_max):
+            if items and items[-1][0] == key:
+                items[-1][1].append(position)
+            else:
+                items.append((key, [position]))
+        self._trim()
+        return items
+
+    def entries(self, kmin = None, kmax = None, include_min = True, include_max = True, after = None, limit = None):
+        """list of the (key, position) pairs with keys between kmin and kmax,
+        the first limit of them behind the entry after if given"""
+        entries = list(itertools.islice(self._iterentries(kmin, kmax, include_min, include_max, after), limit))
+        self._trim()
+        return entries
+
+    def positions(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        """flat list of the values of every key between kmin and kmax, in
+        key order"""
+        positions = [position for key, position in self._iterentries(kmin, kmax, include_min, include_max)]
+        self._trim()
+        return positions
+
+    def keys(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        return [key for key, values in self.items(kmin, kmax, include_min, include_max)]
+
+    def values(self, kmin = None, kmax = None, include_min = True, include_max = True):
+        return [values for key, values in self.items(kmin, kmax, include_min, include_max)]
+
+    def min(self):
+        for key, position in self._iterentries():
+            return key
+        raise IndexError('Index is empty.')
+
+    def max(self):
+        entry = self._last_entry(self._node(self.root_id))
+        if entry is None:
+            raise IndexError('Index is empty.')
+        return entry[0]
+
+    def _last_entry(self, node):
+        # leaves may be empty after deletes, so fall back to left siblings
+        if node.leaf:
+            return node.entries[-1] if node.entries else None
+        for page_id in reversed(node.children):
+            entry = self._last_entry(self._node(page_id))
+            if entry is not None:
+                return entry
+        return None
+
+    def pprint(self):
+        level = [self.root_id]
+        while level:
+            nodes = [self._node(page_id) for page_id in level]
+            print ' '.join(str(node) for node in nodes)
+            level = [child for node in nodes for child in node.children]
@@ -1,25 +1,156 @@
 import api
+import config
+import os
 import re
+import recorder
 import sys
 import time
 
-def exec_file(path):
+# a statement ends at a ';' outside of quotes, an escaped '' inside a
+# string toggles twice and changes nothing
+STATEMENT_BREAK = re.compile(r"[';]")
+
+
+def read_statements(script, chunk_size = None):
+    """Yield the statements of a script one by one, reading it in chunks,
+    so memory is bounded by the longest statement and not the file."""
+    chunk_size = chunk_size or config.script_chunk_size
+    pending = []
+    in_quote = False
+
+    while True:
+        chunk = script.read(chunk_size)
+        if not chunk:
+            break
+
+        start = 0
+        for match in STATEMENT_BREAK.finditer(chunk):
+            if match.group() == "'":
+                in_quote = not in_quote
+            elif not in_quote:
+                pending.append(chunk[start:match.end()])
+                statement = ''.join(pending)
+                pending = []
+                start = match.end()
+
+                if statement[:-1].strip():
+                    yield statement
+
+        pending.append(chunk[start:])
+
+    # a last statement without its ';' still reaches the parser and fails there
+    statement = ''.join(pending)
+    if statement.strip():
+        yield statement
+
+
+class InsertBatch(object):
+    """Rows of consecutive inserts into one table, written with a single
+    insert_records() call."""
+
+    def __init__(self):
+        self.table_name = None
+        self.rows = []
+        self.statements = []        # (number, text, row count)
+
+    def accepts(self, op_dict):
+        return not self.statements or op_dict['table_name'] == self.table_name
+
+    def add(self, number, statement, op_dict):
+        self.table_name = op_dict['table_name']
+        self.rows.extend(op_dict['rows'])
+        self.statements.append((number, statement, len(op_dict['rows'])))
+
+    def write(self):
+        """Returns the number of failed statements."""
+        errors = 0
+
+        if self.statements:
+            try:
+                recorder.insert_records(self.table_name, self.rows)
+            except Exception:
+                # a batch is validated before anything is written, so
+                # nothing of it is stored; insert statement by statement
+                # to find the ones at fault
+                offset = 0
+                for number, statement, row_count in self.statements:
+                    try:
+                        recorder.insert_records(self.table_name, self.rows[offset:offset + row_count])
+                    except Exception, e:
+                        report_error(number, statement, e)
+                        errors += 1
+                    offset += row_count
+
+        self.__init__()
+        return errors
+
+
+def report_error(number, statement, e):
+    print "[-] %d : %s" % (number, statement.strip())
+    print "[-]Error : %s" % e
+
+
+def exec_file(path, quiet = False):
+    """Run a script statement by statement. Consecutive inserts are batched
+    and the log is committed every script_commit_statements statements;
+    quiet mode prints only errors and the progress."""
     print 'File %s'%path
-    file = open(path,'r')
-    lines = file.readlines()
+    script = open(path,'r')
+    size = os.fstat(script.fileno()).st_size
 
-    string = "".join([x.strip("\n") for x in lines]).strip("\n")
-    lines = map(lambda x:x+';',string.split(';'))
+    batch = InsertBatch()
+    count = 0
+    errors = 0
+    start = last_report = time.time()
+
+    for statement in read_statements(script):
+        count += 1
 
-    for i in xrange(len(lines)):
-        line = lines[i]
         try:
-            print "[+] %d : %s" %(i,line)
-            ret = api.do_query(line)
-            if ret:
-                print ret
+            op_dict = api.prepare(statement).bind(())
         except Exception,e:
-            print "[-]Error : %s" % e
+            report_error(count, statement, e)
+            errors += 1
+            continue
+
+        if not quiet:
+            print "[+] %d : %s" % (count, statement.strip())
+
+        if op_dict['op'] == 'insert':
+            if not batch.accepts(op_dict):
+                errors += batch.write()
+            batch.add(count, statement, op_dict)
+            if len(batch.rows) >= config.script_batch_size:
+                errors += batch.write()
+        else:
+            errors += batch.write()
+            try:
+                ret = api.run(op_dict)
+                if isinstance(ret, recorder.Cursor):
+                    ret = api.result_to_table(ret)
+                if ret and not quiet:
+                    print ret
+            except Exception,e:
+                report_error(count, statement, e)
+                errors += 1
+
+        if count % config.script_commit_statements == 0:
+            errors += batch.write()
+            api.flush()
+
+        if quiet and time.time() - last_report >= config.script_progress_interval:
+            last_report = time.time()
+            print "[*] %d statements, %.1f of %.1f MB, %.0f statements/s" % (
+                count, script.tell() / 1048576.0, size / 1048576.0, count / (last_report - start))
+
+    errors += batch.write()
+    api.flush()
+    script.close()
+
+    elapsed = time.time() - start
+    print "[*] %d statements, %d errors, %.0f statements/s" % (count, errors, count / max(elapsed, 1e-6))
+
+    return count, errors
 
 
 def main():
@@ -32,11 +163,11 @@ def main():
         if str_input == 'quit;':
             break
 
-        match = re.match(r'execfile\s+(?P<path>.+)\s*;',str_input)
+        match = re.match(r'execfile\s+(?P<path>.+?)(?P<quiet>\s+quiet)?\s*;\s*$',str_input)
 
         if match:
             start = time.time()
-            exec_file(match.group('path'))
+            exec_file(match.group('path'), bool(match.group('quiet')))
             end = time.time()
             print "Time escaped %f " % (end-start)
 
@@ -51,5 +182,7 @@ def main():
 
         api.flush()
 
+    api.close()
+
 if __name__ == '__main__':
     main()
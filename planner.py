@@ -0,0 +1,215 @@
+import bisect
+
+# relative cost of the basic operations, in units of one index entry read
+ENTRY_COST = 1.0
+FETCH_COST = 4.0
+SCAN_COST = 1.5         # per record of a sequential scan of the table file
+
+# <> is answered by reading the complement from the index
+INVERSE_OPS = ('<>',)
+
+# fraction of rows assumed to pass a condition on a column without statistics
+DEFAULT_SELECTIVITY = {'=': 0.1, '<>': 0.9, '<': 0.3, '>': 0.3, '<=': 0.3, '>=': 0.3}
+
+HISTOGRAM_BUCKETS = 32
+REANALYZE_FRACTION = 0.2
+REANALYZE_MINIMUM = 1000
+
+
+class ColumnStatistics(object):
+    """Entry count, key range and an equi-depth histogram of one index.
+
+    Counts, bounds and bucket sizes follow every insert and delete, the
+    distinct key count every insert; the bucket boundaries are only
+    recomputed by analyze(), which callers run again once is_stale() says
+    so."""
+
+    def __init__(self, unique = False):
+        self.unique = unique
+        self.count = 0
+        self.distinct = 0
+        self.min = None
+        self.max = None
+        self.bounds = []        # lowest key of each bucket
+        self.buckets = []       # entries per bucket
+        self.modified = 0
+
+    def analyze(self, entries):
+        """Rebuild from (key, position) pairs in key order."""
+        self.count = 0
+        self.distinct = 0
+        self.min = None
+        self.max = None
+        self.bounds = []
+        self.buckets = []
+        self.modified = 0
+
+        key_counts = []
+        for key, position in entries:
+            if key_counts and key_counts[-1][0] == key:
+                key_counts[-1][1] += 1
+            else:
+                key_counts.append([key, 1])
+            self.count += 1
+
+        if not key_counts:
+            return
+
+        self.distinct = len(key_counts)
+        self.min = key_counts[0][0]
+        self.max = key_counts[-1][0]
+
+        depth = max(self.count // HISTOGRAM_BUCKETS, 1)
+        filled = depth
+        for key, count in key_counts:
+            if filled >= depth:
+                self.bounds.append(key)
+                self.buckets.append(0)
+                filled = 0
+            self.buckets[-1] += count
+            filled += count
+
+    def is_stale(self):
+        return self.modified > max(REANALYZE_MINIMUM, self.count * REANALYZE_FRACTION)
+
+    def _bucket(self, key):
+        return max(bisect.bisect_right(self.bounds, key) - 1, 0)
+
+    def add(self, key, new_key):
+        """new_key tells whether the index held no entry of key before"""
+        if self.count == 0 or key < self.min:
+            self.min = key
+        if self.count == 0 or key > self.max:
+            self.max = key
+
+        self.count += 1
+        self.modified += 1
+        if new_key:
+            self.distinct += 1
+
+        if not self.buckets:
+            self.bounds.append(key)
+            self.buckets.append(0)
+        self.buckets[self._bucket(key)] += 1
+
+    def remove(self, key):
+        self.count = max(self.count - 1, 0)
+        self.modified += 1
+        if self.unique:
+            self.distinct = max(self.distinct - 1, 0)
+
+        if self.buckets:
+            i = self._bucket(key)
+            self.buckets[i] = max(self.buckets[i] - 1, 0)
+
+    def _below(self, value):
+        """estimated number of entries with key < value"""
+        if value <= self.min:
+            return 0.0
+        if value > self.max:
+            return float(self.count)
+
+        i = self._bucket(value)
+        low = self.bounds[i]
+        high = self.bounds[i + 1] if i + 1 < len(self.bounds) else self.max
+
+        # interpolate inside numeric buckets, assume the middle otherwise
+        if isinstance(value, (int, long, float)) and high > low:
+            fraction = (value - low) / float(high - low)
+        else:
+            fraction = 0.5
+
+        return sum(self.buckets[:i]) + self.buckets[i] * min(max(fraction, 0.0), 1.0)
+
+    def estimate(self, op, value):
+        """estimated number of entries satisfying key op value"""
+        if self.count == 0:
+            return 0.0
+
+        if value < self.min or value > self.max:
+            equal = 0.0
+        else:
+            equal = self.count / float(max(self.distinct, 1))
+
+        if op == '=':
+            return equal
+        if op == '<>':
+            return self.count - equal
+
+        below = self._below(value)
+
+        if op == '<':
+            rows = below
+        elif op == '<=':
+            rows = below + equal
+        elif op == '>':
+            rows = self.count - below - equal
+        elif op == '>=':
+            rows = self.count - below
+        else:
+            raise Exception('Unexpected operator: %s' % op)
+
+        return min(max(rows, 0.0), float(self.count))
+
+    def lookup_entries(self, op, rows):
+        """index entries read to answer a condition matching rows entries"""
+        if op in INVERSE_OPS:
+            return float(self.count)
+        return rows
+
+
+def choose_access_path(candidates, row_count):
+    """Pick the index lookups worth doing for a conjunction of conditions.
+
+    candidates is a list of tuples starting with (condition, statistics,
+    value), one per condition on an indexed column. Lookups are added
+    greedily, cheapest first, while the entries they read cost less than
+    the record fetches they save.
+    Returns the chosen candidates in evaluation order; an empty list means
+    a full scan is cheaper and every condition stays a residual filter."""
+
+    estimated = []
+    for candidate in candidates:
+        condition, statistics, value = candidate[:3]
+        rows = statistics.estimate(condition['op'], value)
+        entries = statistics.lookup_entries(condition['op'], rows)
+        estimated.append((entries * ENTRY_COST + rows * FETCH_COST, rows, entries, candidate))
+
+    estimated.sort(key = lambda x: x[0])
+
+    chosen = []
+    rows = float(row_count)
+    cost = 0.0
+
+    for single_cost, candidate_rows, entries, candidate in estimated:
+        selectivity = candidate_rows / float(max(row_count, 1))
+
+        if not chosen:
+            new_rows = candidate_rows
+        else:
+            new_rows = rows * selectivity
+        new_cost = cost + entries * ENTRY_COST
+
+        if not chosen or new_cost + new_rows * FETCH_COST < cost + rows * FETCH_COST:
+            chosen.append(candidate)
+            rows = new_rows
+            cost = new_cost
+
+    if not chosen or cost + rows * FETCH_COST >= row_count * SCAN_COST:
+        return []
+
+    return chosen
+
+
+def order_filters(filters):
+    """Sort residual filters, (condition, statistics, value) tuples with
+    None for a column without statistics, most selective first so that a
+    rejected row fails its first comparison as often as possible."""
+
+    def selectivity(candidate):
+        condition, statistics, value = candidate
+        if statistics is None or statistics.count == 0:
+            return DEFAULT_SELECTIVITY[condition['op']]
+        return statistics.estimate(condition['op'], value) / float(statistics.count)
+
+    return sorted(filters, key = selectivity)
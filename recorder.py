@@ -1,21 +1,64 @@
-import pickle
+import atexit
+import collections
+import itertools
 import struct
 import os
 import config
 import buffer
-import re
-from b_plus_tree import BPTree
-
-table_dict = {}
+import planner
+import catalog
+import columnar
+import wal
+from disk_b_plus_tree import DiskBPTree
+
+SCAN_CHUNK_SIZE = 64 * 1024
+INDEX_CHUNK_ENTRIES = 1024
+
+RECORD_LIVE = 1
+RECORD_LIVE_BYTE = chr(RECORD_LIVE)
+RECORD_FREE_BYTE = chr(0)
+
+# comparisons spelled in Python, for compile_predicate()
+PYTHON_OPERATORS = {
+    '>': '>',
+    '<': '<',
+    '=': '==',
+    '<>': '!=',
+    '>=': '>=',
+    '<=': '<='
+}
+
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'avg', 'min', 'max')
+
+table_dict = None
 index_dict = {}
 
+log = None
+catalog_file = None
+
+# what the next checkpoint has to add to the catalog file
+changed_tables = set()
+dropped_tables = set()
+indexes_changed = False
+
 
 def get_file_path_from_table_name(table_name):
     return config.table_path + table_name
 
 
 def get_file_object_from_table_name(table_name):
-    return buffer.get_file_object(get_file_path_from_table_name(table_name))
+    return buffer.get_file_object(get_file_path_from_table_name(table_name), config.table_mmap)
+
+
+def get_index_path(table_name, column):
+    if column is None:
+        return config.table_path + table_name + '.primary.idx'
+    return config.table_path + table_name + '.' + column + '.idx'
+
+
+def get_index_key_format(schema):
+    # index keys are encoded like the column in the record file
+    return get_format_string_from_schema([schema])
 
 
 def get_each_record_size(schemas):
@@ -39,30 +82,359 @@ def get_format_string_from_schema(schemas):
     return format_str
 
 
+class RecordCodec(object):
+    """Compiled record layout of one table.
+
+    Built once per table when it is created or the catalog is loaded;
+    the catalog only pickles the schemas and the structs are compiled
+    again on load."""
+
+    def __init__(self, schemas):
+        self.schemas = schemas
+        # every record ends with a status byte, zero marks a free slot
+        self.struct = struct.Struct(get_format_string_from_schema(schemas) + 'B')
+        self.size = self.struct.size
+        self.status_offset = self.size - 1
+        self.columns = [schema['name'] for schema in schemas]
+
+        self.offsets = {}
+        self.formats = {}
+        prefix = ''
+        for schema in schemas:
+            format_str = get_format_string_from_schema([schema])
+            # native alignment may pad before a field
+            self.offsets[schema['name']] = struct.calcsize(prefix + format_str) - struct.calcsize(format_str)
+            self.formats[schema['name']] = format_str
+            prefix += format_str
+
+        self.char_columns = set([schema['name'] for schema in schemas if schema['type'] == 'char'])
+
+        self._projections = {}
+
+    def __getstate__(self):
+        return {'schemas': self.schemas}
+
+    def __setstate__(self, state):
+        self.__init__(state['schemas'])
+
+    def pack(self, values):
+        return self.struct.pack(*(list(values) + [RECORD_LIVE]))
+
+    def is_live(self, data, offset = 0):
+        return data[offset + self.status_offset] == RECORD_LIVE_BYTE
+
+    def projection(self, columns = None):
+        """(struct, column names, char field ids) decoding only columns."""
+        key = tuple(columns) if columns is not None else None
+
+        if key not in self._projections:
+            if columns is None or set(columns) >= set(self.columns):
+                # zip() below drops the trailing status byte
+                record_struct = self.struct
+                names = self.columns
+            else:
+                # skip unwanted byte ranges with pad bytes
+                names = sorted(set(columns), key = lambda x: self.offsets[x])
+                format_str = '='
+                end = 0
+                for name in names:
+                    format_str += '%dx%s' % (self.offsets[name] - end, self.formats[name])
+                    end = self.offsets[name] + struct.calcsize('=' + self.formats[name])
+                record_struct = struct.Struct(format_str)
+
+            char_ids = [i for i in range(len(names)) if names[i] in self.char_columns]
+            self._projections[key] = (record_struct, names, char_ids)
+
+        return self._projections[key]
+
+    def decode(self, data, offset = 0, columns = None):
+        record_struct, names, char_ids = self.projection(columns)
+
+        values = list(record_struct.unpack_from(data, offset))
+        for i in char_ids:
+            values[i] = values[i].strip('\x00')
+
+        return dict(zip(names, values))
+
+
+def encode_table_catalog(table_catalog):
+    """Plain data stored for a table in the catalog file; indexes are only
+    named by their column, the trees stay in their own files."""
+    return {
+        'record_count': table_catalog['record_count'],
+        'schemas': table_catalog['schemas'],
+        'primary_key_column': table_catalog['primary_key_column'],
+        'index_columns': sorted(table_catalog['indexes'].keys()),
+        'statistics': table_catalog['statistics'],
+        'free_positions': sorted(table_catalog['free_positions'])
+    }
+
+
+def decode_table_catalog(table_name, entry):
+    schemas = entry['schemas']
+    column_to_id = dict([(schemas[i]['name'], i) for i in range(len(schemas))])
+    primary_key_column = entry['primary_key_column']
+
+    def open_index(column):
+        key_schema = schemas[column_to_id[column or primary_key_column]]
+        return DiskBPTree(get_index_path(table_name, column), get_index_key_format(key_schema))
+
+    return {
+        'record_count': entry['record_count'],
+        'schemas': schemas,
+        'column_to_id': column_to_id,
+        'primary_key_pos': column_to_id[primary_key_column],
+        'primary_key_column': primary_key_column,
+        'primary_index': open_index(None),
+        'indexes': dict([(column, open_index(column)) for column in entry['index_columns']]),
+        'unique': dict([(schema['name'], schema['unique']) for schema in schemas]),
+        'codec': RecordCodec(schemas),
+        'statistics': entry['statistics'],
+        'free_positions': set(entry['free_positions'])
+    }
+
+
+class TableCatalogs(object):
+    """Catalog entries of every table, decoded from the catalog file on
+    first access.
+
+    Tables unchanged since the last checkpoint can always be read back, so
+    once more than config.table_cache_size are decoded the least recently
+    used of those are closed."""
+
+    def __init__(self, table_names):
+        self._names = set(table_names)
+        self._loaded = collections.OrderedDict()
+
+    def __contains__(self, table_name):
+        return table_name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return list(self._names)
+
+    def items(self):
+        return [(table_name, self[table_name]) for table_name in self.keys()]
+
+    def values(self):
+        return [self[table_name] for table_name in self.keys()]
+
+    def iteritems(self):
+        for table_name in self.keys():
+            yield table_name, self[table_name]
+
+    def __getitem__(self, table_name):
+        if table_name not in self._names:
+            raise KeyError(table_name)
+
+        table_catalog = self._loaded.pop(table_name, None)
+        if table_catalog is None:
+            table_catalog = decode_table_catalog(table_name, catalog_file.read_entry(table_name))
+
+        self._loaded[table_name] = table_catalog
+        self._evict()
+        return table_catalog
+
+    def __setitem__(self, table_name, table_catalog):
+        self._names.add(table_name)
+        self._loaded.pop(table_name, None)
+        self._loaded[table_name] = table_catalog
+        self._evict()
+
+    def __delitem__(self, table_name):
+        self._names.remove(table_name)
+        self._loaded.pop(table_name, None)
+
+    def is_loaded(self, table_name):
+        return table_name in self._loaded
+
+    def _evict(self):
+        excess = len(self._loaded) - config.table_cache_size
+        if excess <= 0:
+            return
+
+        # the table just accessed stays, its caller is still using it
+        for table_name in self._loaded.keys()[:-1]:
+            if table_name in changed_tables:
+                continue
+
+            table_catalog = self._loaded.pop(table_name)
+            table_catalog['primary_index'].close()
+            for index in table_catalog['indexes'].values():
+                index.close()
+
+            excess -= 1
+            if excess <= 0:
+                return
+
+
 def init_table_file():
     global table_dict
     global index_dict
+    global catalog_file
+
+    catalog_file = catalog.CatalogFile(config.table_file)
+
+    # only the table names are read here
+    table_names, index_dict, checkpoint_lsn = catalog_file.load()
+    table_dict = TableCatalogs(table_names)
+
+    recover(checkpoint_lsn)
+
+
+def recover(checkpoint_lsn):
+    """Open the log and redo every change made after the last checkpoint.
+
+    Record and tombstone writes are replayed as they were logged. Indexes,
+    statistics and free slots of the tables involved may be older or newer
+    than the table file, so they are derived from the file again."""
+    global log
+
+    log = wal.WriteAheadLog(config.log_file)
+    buffer.before_write_back = log.sync
+    # statements still waiting for their group are kept on a normal exit
+    atexit.register(log.sync)
+
+    changed_tables = set()
+
+    log.replaying = True
+    try:
+        for lsn, record in log.records():
+            log.lsn = lsn
+            if lsn > checkpoint_lsn:
+                changed_tables.add(redo(record))
+    finally:
+        log.replaying = False
+
+    log.lsn = max(log.lsn, checkpoint_lsn)
+    log.synced_lsn = log.lsn
+
+    for table_name in changed_tables:
+        if table_name in table_dict:
+            rebuild_table(table_name)
+
+    # also cuts off a torn record, nothing may be appended after it
+    if log.size():
+        checkpoint()
+
+
+def redo(record):
+    """Apply one log record again, returns the name of the table it changed."""
+    op, table_name = record[0], record[1]
+
+    if op == 'create_table':
+        create_table_file(table_name, record[2])
+    elif op == 'drop_table':
+        delete_table_file(table_name)
+    elif op == 'create_index':
+        create_index(table_name, record[2], record[3])
+    elif op == 'drop_index':
+        delete_index(record[2])
+    elif op == 'insert':
+        file_object = get_file_object_from_table_name(table_name)
+        for pos, data in record[2]:
+            file_object.write(data, pos)
+    elif op == 'delete':
+        file_object = get_file_object_from_table_name(table_name)
+        status_offset = table_dict[table_name]['codec'].status_offset
+        for pos in record[2]:
+            file_object.write(RECORD_FREE_BYTE, pos + status_offset)
+    elif op == 'vacuum':
+        compact_table_file(table_name)
+    else:
+        raise Exception('Unexpected log record: %s' % op)
+
+    return table_name
+
+
+def rebuild_table(table_name):
+    """Bulk load every index of a table from its file and recount it."""
+
+    table_catalog = table_dict[table_name]
+    codec = table_catalog['codec']
+
+    key_columns = [table_catalog['primary_key_column']] + table_catalog['indexes'].keys()
+    records = read_records(table_name, None, key_columns, True)
+
+    for column, index in [(None, table_catalog['primary_index'])] + table_catalog['indexes'].items():
+        key_column = column or table_catalog['primary_key_column']
+        rebuilt = DiskBPTree.bulk_load(index.path, index.key_format,
+                                       [(x[key_column], x['#_pos']) for x in records],
+                                       config.index_fill_factor)
+
+        if column is None:
+            table_catalog['primary_index'] = rebuilt
+        else:
+            table_catalog['indexes'][column] = rebuilt
+
+        statistics = planner.ColumnStatistics(is_unique_index(table_catalog, column))
+        statistics.analyze(rebuilt.iterentries())
+        table_catalog['statistics'][column] = statistics
+
+    table_catalog['record_count'] = len(records)
+
+    file_object = get_file_object_from_table_name(table_name)
+    end = file_object.size - file_object.size % codec.size
+    table_catalog['free_positions'] = \
+        set(xrange(0, end, codec.size)).difference([x['#_pos'] for x in records])
+
+    mark_changed(table_name)
+
 
-    if os.path.isfile(config.table_file):
-        table_file = open(config.table_file, 'rb')
-        table_dict = pickle.load(table_file)
-        table_file.close()
+def mark_changed(table_name, indexes = False):
+    global indexes_changed
+    changed_tables.add(table_name)
+    if indexes:
+        indexes_changed = True
 
-    if os.path.isfile(config.index_file):
-        index_file = open(config.index_file, 'rb')
-        index_dict = pickle.load(index_file)
-        index_file.close()
+
+def mark_dropped(table_name):
+    global indexes_changed
+    changed_tables.discard(table_name)
+    dropped_tables.add(table_name)
+    indexes_changed = True
 
 
 def update_catalog_file():
+    global indexes_changed
+
+    # only tables changed since the last checkpoint have index pages to
+    # write back and an entry to add to the catalog
+    for table_name in changed_tables:
+        table_catalog = table_dict[table_name]
+        table_catalog['primary_index'].flush()
+        for index in table_catalog['indexes'].values():
+            index.flush()
+
+    buffer.flush_all(True)
+
+    catalog_file.save(dict([(table_name, encode_table_catalog(table_dict[table_name]))
+                            for table_name in changed_tables]),
+                      dropped_tables, index_dict if indexes_changed else None, log.lsn)
+
+    changed_tables.clear()
+    dropped_tables.clear()
+    indexes_changed = False
 
-    table_file = open(config.table_file, 'wb')
-    pickle.dump(table_dict, table_file)
-    table_file.close()
 
-    index_file = open(config.index_file, 'wb')
-    pickle.dump(index_dict, index_file)
-    index_file.close()
+def checkpoint():
+    """Write back every change and the catalog, then empty the log."""
+    log.sync()
+    update_catalog_file()
+    log.truncate()
+
+
+def commit():
+    """End of a statement. The log is synced for a group of statements at
+    once and checkpointed when it grows too long to replay quickly."""
+    log.commit()
+    if log.size() >= config.checkpoint_log_size:
+        checkpoint()
 
 
 def create_table_file(table_name, schemas):
@@ -76,8 +448,10 @@ def create_table_file(table_name, schemas):
     if table_name in table_dict.keys():
         raise Exception('Table already exists.')
 
+    logged_schemas = [schema.copy() for schema in schemas]
+
     for i in range(len(schemas)):
-        if schemas[i]['type'] is 'primary_key':
+        if schemas[i]['type'] == 'primary_key':
             if primary_key_schema is not None:
                 raise Exception('Duplicate primary key')
             primary_key_schema = schemas[i].copy()
@@ -98,28 +472,42 @@ def create_table_file(table_name, schemas):
         'primary_key_column': primary_key_schema['name'],
         'primary_index': None,
         'indexes': {},
-        'unique':column_is_unique
+        'unique':column_is_unique,
+        'codec': RecordCodec(schemas),
+        'statistics': {},
+        'free_positions': set()
     }
 
+    # a file left by a table of the same name that never got logged
+    get_file_object_from_table_name(table_name).truncate()
+
     create_index(table_name,None,None)
 
     for i in range(len(schemas)):
         if schemas[i]['unique']:
-            create_index(table_name,"#_unique_%s" % schemas[i]['name'],schemas[i]['name'])
+            create_index(table_name,"#_unique_%s" % schemas[i]['name'],schemas[i]['name'],False)
+
+    mark_changed(table_name, True)
+    log.append('create_table', table_name, logged_schemas)
 
 
 def handle_value_type_pair(value,schema):
+    # values arrive typed from the parser: str for quoted literals, int or
+    # float for numbers
 
     if schema['type'] == 'char':
-        matches = re.match(r'\'(?P<string>.+)\'', value)
-        if matches is None:
+        if not isinstance(value, basestring):
             raise Exception("Char value syntax error.")
-        return matches.group('string')
+        return value
 
     elif schema['type'] == 'int':
+        if not isinstance(value, (int, long, float)) or value != int(value):
+            raise Exception("Int value syntax error.")
         return int(value)
 
     elif schema['type'] == 'float':
+        if not isinstance(value, (int, long, float)):
+            raise Exception("Float value syntax error.")
         return float(value)
     else:
         raise Exception('Unexpected type: %s' % schema['type'])
@@ -128,58 +516,92 @@ def delete_table_file(table_name):
     if table_name not in table_dict.keys():
         raise Exception("Table doesn't exists.")
 
+    # removing the files can't be undone, the drop must be durable first
+    log.append('drop_table', table_name)
+    log.sync()
+
     for index_name,index_specifier in index_dict.items():
         index_table_name = index_specifier[0]
         if index_table_name == table_name:
             del index_dict[index_name]
 
+    table_dict[table_name]['primary_index'].drop()
+    for index in table_dict[table_name]['indexes'].values():
+        index.drop()
+
     del table_dict[table_name]
+    mark_dropped(table_name)
 
     file_object = get_file_object_from_table_name(table_name)
     file_object.delete()
 
 def insert_record(table_name, values):
+    insert_records(table_name, [values])
 
-    table_catalog = table_dict[table_name]
 
-    if table_catalog is None:
+def insert_records(table_name, rows):
+
+    if table_name not in table_dict:
         raise Exception('Table doesn\'t exists.')
 
-    file_object = get_file_object_from_table_name(table_name)
+    table_catalog = table_dict[table_name]
 
-    format_string = get_format_string_from_schema(table_catalog['schemas'])
+    file_object = get_file_object_from_table_name(table_name)
 
     schemas = table_catalog['schemas']
 
-    if len(values) != len(schemas):
-        print values
-        print schemas
-        raise Exception('Value number doesn\'t match')
+    codec = table_catalog['codec']
+
+    parsed_rows = []
+    for values in rows:
+        if len(values) != len(schemas):
+            raise Exception('Value number doesn\'t match')
 
-    value_parsed = map(lambda x:handle_value_type_pair(x[0],x[1]), zip(values, schemas))
+        parsed_rows.append(map(lambda x:handle_value_type_pair(x[0],x[1]), zip(values, schemas)))
 
-    for column,unique in table_dict[table_name]['unique'].iteritems():
+    # the whole batch is validated before anything is written
+    for column,unique in table_catalog['unique'].iteritems():
         if unique:
-            index = table_dict[table_name]['indexes'][column]
-            id = table_dict[table_name]['column_to_id'][column]
-            key = value_parsed[id]
+            index = table_catalog['indexes'][column]
+            id = table_catalog['column_to_id'][column]
+            seen = set()
+
+            for value_parsed in parsed_rows:
+                # compared as the index stores them, cut or rounded
+                key = index.normalize(value_parsed[id])
+
+                if key in seen or index.contains(key):
+                    raise Exception("Duplicate unique key.")
+                seen.add(key)
 
-            if key in index.keys():
-                raise Exception("Duplicate unique key.")
+    records = [codec.pack(value_parsed) for value_parsed in parsed_rows]
 
-    primary_key_value = value_parsed[table_dict[table_name]['primary_key_pos']]
+    # free slots left by deletes are filled first, the rest is appended
+    free_positions = table_catalog['free_positions']
+    reused = min(len(free_positions), len(parsed_rows))
 
-    data = struct.pack(format_string,*value_parsed)
+    positions = sorted([free_positions.pop() for i in xrange(reused)])
+    positions += range(file_object.size, file_object.size + (len(records) - reused) * codec.size, codec.size)
 
-    start_pos = file_object.write(data)
+    log.append('insert', table_name, zip(positions, records))
 
-    table_dict[table_name]['record_count'] += 1
+    for data, pos in zip(records, positions[:reused]):
+        file_object.write(data, pos)
 
-    table_dict[table_name]['primary_index'].insert(primary_key_value,start_pos)
+    file_object.write(''.join(records[reused:]))
 
-    for column, index in table_dict[table_name]['indexes'].iteritems():
-        id = table_dict[table_name]['column_to_id'][column]
-        index.insert(value_parsed[id],start_pos)
+    table_catalog['record_count'] += len(parsed_rows)
+    mark_changed(table_name)
+
+    for column, index in [(None, table_catalog['primary_index'])] + table_catalog['indexes'].items():
+        id = table_catalog['column_to_id'][column or table_catalog['primary_key_column']]
+        keys = [value_parsed[id] for value_parsed in parsed_rows]
+
+        statistics = table_catalog['statistics'][column]
+        for key, new_key in index.insert_many(zip(keys, positions)):
+            statistics.add(key, new_key)
+
+    return positions
 
 def delete_index(index_name):
 
@@ -189,20 +611,29 @@ def delete_index(index_name):
     table_name = index_dict[index_name][0]
     column = index_dict[index_name][1]
 
+    log.append('drop_index', table_name, index_name)
+    log.sync()
+
     del index_dict[index_name]
+    mark_changed(table_name, True)
 
     if not table_dict[table_name]['unique'][column]:
+        table_dict[table_name]['indexes'][column].drop()
         del table_dict[table_name]['indexes'][column]
+        del table_dict[table_name]['statistics'][column]
 
-def create_index(table_name, index_name, column):
+def create_index(table_name, index_name, column, logged = True):
 
     if table_name not in table_dict:
         raise Exception('Table doesn\'t exsists.')
 
-    index = BPTree(32)
+    table_catalog = table_dict[table_name]
 
     if index_name is None:
-        table_dict[table_name]['primary_index'] = index
+        key_schema = table_catalog['schemas'][table_catalog['primary_key_pos']]
+        table_catalog['primary_index'] = DiskBPTree(get_index_path(table_name, None),
+                                                    get_index_key_format(key_schema), True)
+        table_catalog['statistics'][None] = planner.ColumnStatistics(is_unique_index(table_catalog, None))
     else:
 
         if index_name in index_dict.keys():
@@ -212,28 +643,81 @@ def create_index(table_name, index_name, column):
             if table_dict[table_name]['unique'][column]:
 
                 index_dict[index_name] = [table_name,column]
+                mark_changed(table_name, True)
+                if logged:
+                    log.append('create_index', table_name, index_name, column)
                 return
 
             raise Exception("Index for column %s already exists." % column)
 
-        positions,dummy = select_record_position(table_name,None)
-        record = read_records(table_name,positions,[column])
+        record = read_records(table_name,None,[column],True)
 
-        map(lambda pair:index.insert(*pair), zip([x[column] for x in record],positions))
+        key_schema = table_catalog['schemas'][table_catalog['column_to_id'][column]]
+        index = DiskBPTree.bulk_load(get_index_path(table_name, column),
+                                     get_index_key_format(key_schema),
+                                     [(x[column], x['#_pos']) for x in record],
+                                     config.index_fill_factor)
 
         table_dict[table_name]['indexes'][column] = index
 
+        statistics = planner.ColumnStatistics(is_unique_index(table_catalog, column))
+        statistics.analyze(index.iterentries())
+        table_catalog['statistics'][column] = statistics
+
         index_dict[index_name] = [table_name,column]
+        mark_changed(table_name, True)
+        if logged:
+            log.append('create_index', table_name, index_name, column)
+
+
+def is_unique_index(table_catalog, column):
+    return table_catalog['unique'][column or table_catalog['primary_key_column']]
+
+
+def get_index_statistics(table_catalog, column, index):
+    statistics = table_catalog['statistics'][column]
+    if statistics.is_stale():
+        statistics.analyze(index.iterentries())
+    return statistics
+
+
+def get_column_statistics(table_catalog, column):
+    """statistics of the index on column, None for an unindexed column"""
+    if column == table_catalog['primary_key_column']:
+        return table_catalog['statistics'][None]
+    return table_catalog['statistics'].get(column)
+
+
+def get_column_index(table_catalog, column):
+    """the index on column, None for an unindexed column"""
+    if column == table_catalog['primary_key_column']:
+        return table_catalog['primary_index']
+    return table_catalog['indexes'].get(column)
+
+
+def compile_predicate(names, filters):
+    """Fuse (column, op, value) filters into one function of the values
+    decoded in the order of names. Filters are tested in the order given,
+    stopping at the first one that fails; None stands for no filter."""
+    if not filters:
+        return None
+
+    namespace = {}
+    terms = []
+    for i, (column, op, value) in enumerate(filters):
+        namespace['value_%d' % i] = value
+        terms.append('values[%d] %s value_%d' % (names.index(column), PYTHON_OPERATORS[op], i))
+
+    return eval('lambda values: ' + ' and '.join(terms), namespace)
 
 
 def select_record_position(table_name,conditions):
 
     table_catalog = table_dict[table_name]
-    index  = table_catalog['primary_index']
 
     require_filter_condition = []
 
-    pos_list = None
+    candidates = []
 
     if conditions is not None:
         for condition in conditions:
@@ -241,172 +725,601 @@ def select_record_position(table_name,conditions):
             id = table_catalog['column_to_id'][condition['left']]
             right_value = handle_value_type_pair(condition['right'],table_catalog['schemas'][id])
 
-            index = None
-            max = None
-            min = None
-            inverse = False
-            range_query = True
-
-            if condition['left'] == table_dict[table_name]['primary_key_column']:
-                index = table_dict[table_name]['primary_index']
+            if condition['left'] == table_catalog['primary_key_column']:
+                column = None
+                index = table_catalog['primary_index']
 
-            elif condition['left'] in table_dict[table_name]['indexes']:
-                index = table_dict[table_name]['indexes'][condition['left']]
+            elif condition['left'] in table_catalog['indexes']:
+                column = condition['left']
+                index = table_catalog['indexes'][column]
 
             else:
                 require_filter_condition.append(condition)
+                continue
 
-            if index is not None:
+            statistics = get_index_statistics(table_catalog, column, index)
+            candidates.append((condition, statistics, right_value, index))
 
-                if condition['op'] == '>':
-                    max = right_value
-                    inverse = True
+    # the planner decides which indexed conditions are worth a lookup,
+    # the others are left to the residual filter like unindexed ones
+    chosen = planner.choose_access_path(candidates, table_catalog['record_count'])
 
-                elif condition['op'] == '<':
-                    min = right_value
-                    inverse = True
+    for candidate in candidates:
+        if candidate not in chosen:
+            require_filter_condition.append(candidate[0])
 
-                elif condition['op'] == '=':
-                    range_query = False
+    pos_list = None
+
+    for condition, statistics, right_value, index in chosen:
 
-                elif condition['op'] == '<>':
-                    range_query = False
-                    inverse = True
+        max = None
+        min = None
+        include_min = True
+        include_max = True
+        inverse = False
+        range_query = True
+
+        if condition['op'] == '>':
+            min = right_value
+            include_min = False
 
-                elif condition['op'] == '>=':
-                    min = right_value
+        elif condition['op'] == '<':
+            max = right_value
+            include_max = False
 
-                elif condition['op'] == '<=':
-                    max = right_value
+        elif condition['op'] == '=':
+            range_query = False
 
-                if range_query:
-                    current_pos_list = index.values(min,max)
-                else:
-                    current_pos_list = [index[right_value]] if index[right_value] else []
+        elif condition['op'] == '<>':
+            range_query = False
+            inverse = True
 
-                current_pos_list = [ y for x in current_pos_list for y in x if y is not None ]
+        elif condition['op'] == '>=':
+            min = right_value
 
-                if pos_list is None:
-                    pos_list = current_pos_list
-                else:
-                    if not inverse:
-                        pos_list = [x  for x in pos_list if x in current_pos_list]
-                    else:
-                        pos_list = [x  for x in pos_list if x not in current_pos_list]
+        elif condition['op'] == '<=':
+            max = right_value
 
-    if pos_list is None:
-        pos_list = [ y for x in table_catalog['primary_index'].values() for y in x if y is not None ]
+        if range_query:
+            current_pos_list = index.positions(min,max,include_min,include_max)
+        else:
+            current_pos_list = index.get(right_value, [])
+
+        if pos_list is None and not inverse:
+            pos_list = current_pos_list
+        elif pos_list is None:
+            pos_list = subtract_positions(table_catalog['primary_index'].positions(), current_pos_list)
+        elif not inverse:
+            pos_list = intersect_positions(pos_list, current_pos_list)
+        else:
+            pos_list = subtract_positions(pos_list, current_pos_list)
 
+    # None asks read_records for a sequential scan of the table file
     return pos_list,require_filter_condition
 
 
+def intersect_positions(pos_list, other):
+    """AND of two position lists, in file order."""
+    return sorted(set(pos_list).intersection(other))
+
+
+def subtract_positions(pos_list, other):
+    """AND NOT of two position lists, in file order."""
+    return sorted(set(pos_list).difference(other))
+
+
 def read_records(table_name,record_positions,columns,with_position = False):
+    return list(iter_records(table_name,record_positions,columns,with_position))
+
+
+def iter_records(table_name,record_positions,columns,with_position = False,filters = None):
+    """Yield records one at a time, by position or, given None, in file order.
+    Records failing one of the (column, op, value) filters are dropped as
+    they are decoded; columns must include the filtered ones."""
+
+    if record_positions is None:
+        return scan_records(table_name,columns,with_position,filters)
+
+    return fetch_records(table_name,record_positions,columns,with_position,filters)
+
+
+def fetch_records(table_name,record_positions,columns,with_position = False,filters = None):
 
     table_catalog = table_dict[table_name]
 
     file_object = get_file_object_from_table_name(table_name)
 
-    format_string = get_format_string_from_schema(table_catalog['schemas'])
+    codec = table_catalog['codec']
+    record_struct, names, char_ids = codec.projection(columns)
+    predicate = compile_predicate(names, filters)
 
-    record_length = get_each_record_size(table_catalog['schemas'])
+    for pos in record_positions:
+        data, start = file_object.view(pos, codec.size)
+        # an index entry left behind must not bring a deleted record back
+        if not codec.is_live(data, start):
+            continue
 
-    data_string_list = [ file_object.read(pos,record_length) for pos in record_positions]
+        values = list(record_struct.unpack_from(data, start))
+        for i in char_ids:
+            values[i] = values[i].strip('\x00')
 
+        if predicate is not None and not predicate(values):
+            continue
 
-    raw_records_list = map(lambda data_str:[ (x.strip('\x00')
-                        if type(x) is str else x) for x in struct.unpack(format_string,data_str)],
-                       data_string_list)
+        current_record_dict = dict(zip(names, values))
 
-    record_list = []
+        if with_position:
+            current_record_dict['#_pos'] = pos
 
-    for i in range(len(raw_records_list)):
-        record = raw_records_list[i]
+        yield current_record_dict
 
-        current_record_dict = {}
 
-        for column,id in table_catalog['column_to_id'].iteritems():
-            current_record_dict[column] = record[id]
+def scan_records(table_name,columns,with_position = False,filters = None):
+    """Read every live record in file order, a large chunk at a time."""
 
-        if with_position:
-            current_record_dict['#_pos'] = record_positions[i]
+    table_catalog = table_dict[table_name]
 
-        record_list.append(current_record_dict)
+    file_object = get_file_object_from_table_name(table_name)
 
-    return record_list
+    codec = table_catalog['codec']
+    record_struct, names, char_ids = codec.projection(columns)
+    predicate = compile_predicate(names, filters)
 
+    chunk_size = max(SCAN_CHUNK_SIZE // codec.size, 1) * codec.size
+    end = file_object.size - file_object.size % codec.size
 
-def select_record(table_name,columns,conditions,with_position = False):
+    for chunk_start in xrange(0, end, chunk_size):
+        length = min(chunk_size, end - chunk_start)
+        data, start = file_object.view(chunk_start, length)
 
-    table_catalog = table_dict[table_name]
+        for offset in xrange(start, start + length, codec.size):
+            if not codec.is_live(data, offset):
+                continue
+
+            pos = chunk_start + offset - start
+
+            values = list(record_struct.unpack_from(data, offset))
+            for i in char_ids:
+                values[i] = values[i].strip('\x00')
+
+            if predicate is not None and not predicate(values):
+                continue
+
+            current_record_dict = dict(zip(names, values))
+
+            if with_position:
+                current_record_dict['#_pos'] = pos
+
+            yield current_record_dict
+
+
+def index_only_records(column, index, filters, with_position = False):
+    """Records holding only column, read lazily in key order from the
+    leaves of its index without touching the table file; filters name
+    column only. Keys are encoded like the column in the record file, so
+    the values are the ones a read of the records gives."""
+    kmin = None
+    kmax = None
+    include_min = True
+    include_max = True
+    residual = []
+    for name, op, value in filters:
+        # the tighter bound wins, an exclusive one over an equal inclusive one
+        if op in ('=', '>=', '>'):
+            inclusive = op != '>'
+            if kmin is None or value > kmin or (value == kmin and not inclusive):
+                kmin, include_min = value, inclusive
+        if op in ('=', '<=', '<'):
+            inclusive = op != '<'
+            if kmax is None or value < kmax or (value == kmax and not inclusive):
+                kmax, include_max = value, inclusive
+        if op == '<>':
+            residual.append((name, op, value))
+
+    if kmin is not None and kmax is not None and kmin > kmax:
+        return
+
+    # the bounds answer every filter but <>
+    predicate = compile_predicate([column], residual)
+
+    # a chunk at a time, each looked up again behind the last entry read,
+    # so the tree may change between fetches of the cursor
+    last = None
+    while True:
+        entries = index.entries(kmin, kmax, include_min, include_max, last, INDEX_CHUNK_ENTRIES)
+        for key, position in entries:
+            if predicate is not None and not predicate((key,)):
+                continue
+
+            current_record_dict = {column: key}
+            if with_position:
+                current_record_dict['#_pos'] = position
+            yield current_record_dict
+
+        if len(entries) < INDEX_CHUNK_ENTRIES:
+            return
+        last = entries[-1]
 
-    positions, conditions = select_record_position(table_name, conditions)
+
+class Cursor(object):
+    """Rows of a select, produced lazily as they are fetched."""
+
+    arraysize = 100
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self._rows = rows
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._rows)
+
+    def fetchone(self):
+        return next(self._rows, None)
+
+    def fetchmany(self, size = None):
+        return list(itertools.islice(self._rows, size or self.arraysize))
+
+    def fetchall(self):
+        return list(self._rows)
+
+
+def select_cursor(table_name,columns,conditions,with_position = False):
+
+    if table_name not in table_dict:
+        raise Exception('Table doesn\'t exists.')
+
+    table_catalog = table_dict[table_name]
 
     if '*' in columns:
         columns = [schema['name'] for schema in table_catalog['schemas']]
 
-    least_column = columns
+    for column in columns:
+        if column not in table_catalog['column_to_id']:
+            raise Exception("Column %s doesn't exists." % column)
 
-    for condition in conditions:
-        if condition['left'] not in least_column:
-            least_column.append(condition['left'])
+    # a query on a single indexed column is answered by the index alone
+    covered = set(columns).union([condition['left'] for condition in conditions or []])
+    if len(covered) == 1:
+        column = covered.pop()
+        index = get_column_index(table_catalog, column)
 
-    records = read_records(table_name, positions, least_column, with_position)
+        if index is not None:
+            schema = table_catalog['schemas'][table_catalog['column_to_id'][column]]
+            filters = [(column, condition['op'], handle_value_type_pair(condition['right'], schema))
+                       for condition in conditions or []]
+            records = index_only_records(column, index, filters, with_position)
+            return Cursor(columns + ['#_pos'] if with_position else columns, iter(records))
+
+    positions, conditions = select_record_position(table_name, conditions)
 
-    column_to_id_current_columns = {}
-    for i in range(len(least_column)):
-        column_to_id_current_columns[least_column[i]] = i
+    # only the projected columns and those still needed by a filter are decoded
+    least_column = list(columns)
 
     for condition in conditions:
+        if condition['left'] not in least_column:
+            least_column.append(condition['left'])
 
+    filters = []
+    for condition in conditions:
         id = table_catalog['column_to_id'][condition['left']]
         right_value = handle_value_type_pair(condition['right'], table_catalog['schemas'][id])
+        filters.append((condition, get_column_statistics(table_catalog, condition['left']), right_value))
 
-        if condition['op'] == '>':
-            records = [x for x in records if x[condition['left']] > right_value]
-        elif condition['op'] == '<':
-            records = [x for x in records if x[condition['left']] < right_value]
-        elif condition['op'] == '=':
-            records = [x for x in records if x[condition['left']] == right_value]
-        elif condition['op'] == '<>':
-            records = [x for x in records if x[condition['left']] != right_value]
-        elif condition['op'] == '>=':
-            records = [x for x in records if x[condition['left']] >= right_value]
-        elif condition['op'] == '<=':
-            records = [x for x in records if x[condition['left']] <= right_value]
+    # the most selective filter is tested first
+    filters = [(condition['left'], condition['op'], right_value)
+               for condition, statistics, right_value in planner.order_filters(filters)]
+
+    if positions is None and filters and config.columnar_scan and columnar.available():
+        # masks over the whole file pick the records, only those are decoded
+        codec = table_catalog['codec']
+        array = columnar.table_array(codec, get_file_object_from_table_name(table_name))
+        positions = columnar.positions(columnar.mask(array, filters), codec.size)
+        least_column = list(columns)
+        filters = []
 
     if with_position:
-        columns.append('#_pos')
+        columns = columns + ['#_pos']
+
+    records = iter_records(table_name, positions, least_column, with_position, filters)
+
+    if len(columns) == len(least_column) + with_position:
+        return Cursor(columns, records)
+
+    def rows():
+        for record in records:
+            yield dict([(x, record[x]) for x in columns])
+
+    return Cursor(columns, rows())
+
+
+def select_record(table_name,columns,conditions,with_position = False):
+    return select_cursor(table_name,columns,conditions,with_position).fetchall()
+
+
+def select_aggregate(table_name, aggregates, conditions, group_by = None):
+    """Aggregates, (function, column) pairs with column '*' for count(*),
+    over the records matching conditions; columnar.aggregate() describes
+    the rows returned.
+
+    Counts and the min/max of indexed columns are answered from the
+    catalog and the indexes when they can be, the rest runs on the
+    columnar engine when config.columnar_scan is set and NumPy is
+    installed, row at a time otherwise."""
+
+    if table_name not in table_dict:
+        raise Exception('Table doesn\'t exists.')
+
+    table_catalog = table_dict[table_name]
+    column_to_id = table_catalog['column_to_id']
+
+    for function, column in aggregates:
+        if function not in AGGREGATE_FUNCTIONS:
+            raise Exception('Unknown aggregate %s.' % function)
+        if column == '*':
+            if function != 'count':
+                raise Exception('%s(*) is not supported.' % function)
+        elif column not in column_to_id:
+            raise Exception("Column %s doesn't exists." % column)
+        elif function in ('sum', 'avg') and table_catalog['schemas'][column_to_id[column]]['type'] == 'char':
+            raise Exception("Can't %s char column %s." % (function, column))
+
+    for column in group_by or []:
+        if column not in column_to_id:
+            raise Exception("Column %s doesn't exists." % column)
+
+    filters = []
+    for condition in conditions or []:
+        if condition['left'] not in column_to_id:
+            raise Exception("Column %s doesn't exists." % condition['left'])
+        id = column_to_id[condition['left']]
+        right_value = handle_value_type_pair(condition['right'], table_catalog['schemas'][id])
+        filters.append((condition['left'], condition['op'], right_value))
+
+    if not group_by:
+        row = aggregate_from_indexes(table_name, aggregates, conditions)
+        if row is not None:
+            return [row]
+
+    if config.columnar_scan and columnar.available():
+        array = columnar.table_array(table_catalog['codec'], get_file_object_from_table_name(table_name))
+        return columnar.aggregate(array, columnar.mask(array, filters), aggregates, group_by)
 
-    def filter_record(record):
-        record_dict = {}
-        for x in columns:
-            record_dict[x] = record[x]
-        return record_dict
+    columns = list(group_by or [])
+    for function, column in aggregates:
+        if column != '*' and column not in columns:
+            columns.append(column)
+
+    records = select_cursor(table_name, columns or [table_catalog['primary_key_column']], conditions)
+    return aggregate_records(records, aggregates, group_by)
+
+
+def aggregate_from_indexes(table_name, aggregates, conditions):
+    """The single row of aggregates without reading the table file, or
+    None when one of them needs it.
+
+    Without conditions count comes from record_count and min/max from the
+    first and last key of an index on the column, whose keys are the
+    column values as the records store them and leave with their
+    records. With conditions only
+    counts are answered, by the positions the index lookups give when no
+    residual filter is left."""
+
+    table_catalog = table_dict[table_name]
+
+    if conditions:
+        for function, column in aggregates:
+            if function != 'count':
+                return None
+
+        positions, require_filter_condition = select_record_position(table_name, conditions)
+        if positions is None or require_filter_condition:
+            return None
+
+        return dict([(columnar.aggregate_label(function, column), len(positions))
+                     for function, column in aggregates])
+
+    row = {}
+    for function, column in aggregates:
+        if function == 'count':
+            value = table_catalog['record_count']
+        elif function in ('min', 'max'):
+            index = get_column_index(table_catalog, column)
+            if index is None:
+                return None
+
+            if index.is_empty():
+                value = None
+            elif function == 'min':
+                value = index.min()
+            else:
+                value = index.max()
+        else:
+            return None
+
+        row[columnar.aggregate_label(function, column)] = value
+
+    return row
+
+
+def aggregate_records(records, aggregates, group_by = None):
+    """Row at a time counterpart of columnar.aggregate(), giving the same
+    rows from records holding the aggregated and group_by columns."""
+    group_by = group_by or []
+    groups = {}
+
+    for record in records:
+        key = tuple([record[x] for x in group_by])
+
+        states = groups.get(key)
+        if states is None:
+            # [rows counted, sum, min or max so far] of each aggregate
+            states = groups[key] = [[0, None] for x in aggregates]
+
+        for state, (function, column) in zip(states, aggregates):
+            state[0] += 1
+            if function == 'count':
+                continue
+
+            value = record[column]
+            if state[1] is None:
+                state[1] = value
+            elif function in ('sum', 'avg'):
+                state[1] += value
+            elif function == 'min':
+                state[1] = min(state[1], value)
+            else:
+                state[1] = max(state[1], value)
+
+    if not group_by and not groups:
+        groups[()] = [[0, None] for x in aggregates]
+
+    rows = []
+    for key in sorted(groups.keys()):
+        row = dict(zip(group_by, key))
+
+        for (count, value), (function, column) in zip(groups[key], aggregates):
+            if function == 'count':
+                value = count
+            elif function == 'avg' and count:
+                value = value / float(count)
+            row[columnar.aggregate_label(function, column)] = value
+
+        rows.append(row)
+
+    return rows
 
-    return  [filter_record(record) for record in records ]
 
 def delete_records(table_name,conditions):
 
-    columns = table_dict[table_name]['indexes'].keys()
+    table_catalog = table_dict[table_name]
+
+    columns = table_catalog['indexes'].keys()
 
-    if table_dict[table_name]['primary_key_column'] not in columns:
-        columns.append(table_dict[table_name]['primary_key_column'])
+    if table_catalog['primary_key_column'] not in columns:
+        columns.append(table_catalog['primary_key_column'])
 
     records_to_delete = select_record(table_name,columns,conditions,True)
 
+    log.append('delete', table_name, [record['#_pos'] for record in records_to_delete])
+
+    for column, index in [(None, table_catalog['primary_index'])] + table_catalog['indexes'].items():
+        key_column = column or table_catalog['primary_key_column']
+        statistics = table_catalog['statistics'][column]
+
+        for record in records_to_delete:
+            index.delete(record[key_column],record['#_pos'])
+            statistics.remove(record[key_column])
+
+    table_catalog['record_count'] -= len(records_to_delete)
+    mark_changed(table_name)
+
+    # tombstone the slots and hand them to later inserts
+    file_object = get_file_object_from_table_name(table_name)
+    status_offset = table_catalog['codec'].status_offset
+
     for record in records_to_delete:
-        for record_column,data in record.iteritems():
+        file_object.write(RECORD_FREE_BYTE, record['#_pos'] + status_offset)
+        table_catalog['free_positions'].add(record['#_pos'])
 
-            if table_dict[table_name]['primary_key_column'] == record_column:
-                index = table_dict[table_name]['primary_index']
-            else:
-                if record_column in table_dict[table_name]['indexes'].keys():
-                    index = table_dict[table_name]['indexes'][record_column]
-                else:
-                    index = None
+def copy_live_records(table_name):
+    """Copy the live records of a table into a new file next to it.
+    Returns its path and a dict mapping old positions to new ones."""
+
+    table_catalog = table_dict[table_name]
+    codec = table_catalog['codec']
+
+    file_object = get_file_object_from_table_name(table_name)
+
+    chunk_size = max(SCAN_CHUNK_SIZE // codec.size, 1) * codec.size
+    file_end = file_object.size - file_object.size % codec.size
+
+    new_positions = {}
+    end = 0
+
+    temp_path = file_object.path + '.vacuum'
+    temp_file = open(temp_path, 'wb')
+
+    for chunk_start in xrange(0, file_end, chunk_size):
+        data = file_object.read(chunk_start, min(chunk_size, file_end - chunk_start))
+
+        live = []
+        for offset in xrange(0, len(data), codec.size):
+            if not codec.is_live(data, offset):
+                continue
+
+            live.append(data[offset:offset + codec.size])
+            new_positions[chunk_start + offset] = end
+            end += codec.size
+
+        temp_file.write(''.join(live))
+
+    temp_file.flush()
+    os.fsync(temp_file.fileno())
+    temp_file.close()
+
+    return temp_path, new_positions
+
+
+def replace_table_file(table_name, temp_path):
+    get_file_object_from_table_name(table_name).replace(temp_path)
+    table_dict[table_name]['free_positions'] = set()
+    mark_changed(table_name)
+
+
+def compact_table_file(table_name):
+    """Replace the table file with a copy holding only its live records.
+    Returns a dict mapping old positions to new ones."""
+    temp_path, new_positions = copy_live_records(table_name)
+    replace_table_file(table_name, temp_path)
+    return new_positions
+
+
+def vacuum_table(table_name):
+    """Move live records to the front of the table file, cut off the rest
+    and rebuild every index with the new positions."""
+
+    if table_name not in table_dict:
+        raise Exception("Table doesn't exists.")
+
+    table_catalog = table_dict[table_name]
+
+    # records logged before the vacuum refer to the old layout, so none of
+    # them may be left to replay over the new file
+    checkpoint()
+
+    temp_path, new_positions = copy_live_records(table_name)
+
+    # an entry of a record that is no longer live has no new position;
+    # give up while the table and its indexes are still untouched
+    rebuilt_entries = []
+    for column, index in [(None, table_catalog['primary_index'])] + table_catalog['indexes'].items():
+        entries = []
+        for key, pos in index.iterentries():
+            if pos not in new_positions:
+                os.remove(temp_path)
+                raise Exception("Index on %s refers to a deleted record, vacuum aborted." %
+                                (column or table_catalog['primary_key_column']))
+            entries.append((key, new_positions[pos]))
+        rebuilt_entries.append((column, index, entries))
+
+    log.append('vacuum', table_name)
+    log.sync()
+
+    replace_table_file(table_name, temp_path)
+
+    for column, index, entries in rebuilt_entries:
+        rebuilt = DiskBPTree.bulk_load(index.path, index.key_format, entries, config.index_fill_factor, True)
+
+        if column is None:
+            table_catalog['primary_index'] = rebuilt
+        else:
+            table_catalog['indexes'][column] = rebuilt
+
+    checkpoint()
 
-            if index is not None:
-                index.delete(data,record['#_pos'])
 
 def debug(table_name):
     print table_dict[table_name]['indexes']
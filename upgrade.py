@@ -0,0 +1,152 @@
+#
+# One-shot upgrade of a database written by the original PyMiniSQL.
+#
+# That version pickled its catalog, in-memory BPTree indexes included,
+# into config.table_file and the index names into config.index_file. Its
+# records have no status byte, and a deleted record stayed in the table
+# file and only left the indexes. This reads the records the primary
+# index still refers to and loads them into a new database in the
+# current format, at the same paths. Run it once, before anything else
+# opens the database:
+#
+#     python upgrade.py
+#
+# The original files are kept next to the new ones with ORIGINAL_SUFFIX.
+#
+
+import os
+import pickle
+import struct
+
+import config
+
+ORIGINAL_SUFFIX = '.orig'
+BATCH_SIZE = 1000
+
+
+class LegacyNode(object):
+    pass
+
+
+class LegacyTree(object):
+    pass
+
+
+LEGACY_CLASSES = {
+    ('b_plus_tree', 'BPNode'): LegacyNode,
+    ('b_plus_tree', 'BPTree'): LegacyTree
+}
+
+
+def load_legacy(path):
+    """Unpickle a file of the original version, its trees as plain objects
+    holding the attributes they were pickled with."""
+    legacy_file = open(path, 'rb')
+    unpickler = pickle.Unpickler(legacy_file)
+
+    def find_class(module, name):
+        if (module, name) in LEGACY_CLASSES:
+            return LEGACY_CLASSES[(module, name)]
+        return pickle.Unpickler.find_class(unpickler, module, name)
+
+    unpickler.find_class = find_class
+    try:
+        return unpickler.load()
+    finally:
+        legacy_file.close()
+
+
+def is_legacy_database():
+    if not os.path.isfile(config.table_file):
+        return False
+
+    import catalog
+    table_file = open(config.table_file, 'rb')
+    magic = table_file.read(len(catalog.MAGIC))
+    table_file.close()
+    return magic != catalog.MAGIC
+
+
+def tree_positions(node, positions):
+    """every position held by the leaves below node"""
+    if node.children:
+        for child in node.children:
+            tree_positions(child, positions)
+    else:
+        for values in node.values:
+            positions.extend(values)
+    return positions
+
+
+def format_of(schema):
+    if schema['type'] == 'char':
+        return '%ds' % schema['length']
+    return {'int': 'i', 'float': 'f'}[schema['type']]
+
+
+def read_legacy_rows(path, table_catalog):
+    """The live records of an original table file, in file order."""
+    schemas = table_catalog['schemas']
+    record_struct = struct.Struct(''.join([format_of(schema) for schema in schemas]))
+    char_ids = [i for i in range(len(schemas)) if schemas[i]['type'] == 'char']
+
+    positions = sorted(set(tree_positions(table_catalog['primary_index'].root, [])))
+
+    table_file = open(path, 'rb')
+    data = table_file.read()
+    table_file.close()
+
+    rows = []
+    for pos in positions:
+        values = list(record_struct.unpack_from(data, pos))
+        for i in char_ids:
+            values[i] = values[i].strip('\x00')
+        rows.append(values)
+    return rows
+
+
+def keep_original(path):
+    if os.path.isfile(path):
+        os.rename(path, path + ORIGINAL_SUFFIX)
+        return path + ORIGINAL_SUFFIX
+    return None
+
+
+def upgrade():
+    if not is_legacy_database():
+        print 'No database of the original version at %s.' % config.table_file
+        return
+
+    tables = load_legacy(config.table_file)
+    indexes = load_legacy(config.index_file) if os.path.isfile(config.index_file) else {}
+
+    keep_original(config.table_file)
+    keep_original(config.index_file)
+    table_paths = dict([(table_name, keep_original(config.table_path + table_name)) for table_name in tables])
+
+    # opens a new, empty catalog at the same paths
+    import api
+    import recorder
+
+    for table_name, table_catalog in tables.iteritems():
+        schemas = [schema.copy() for schema in table_catalog['schemas']]
+        schemas.append({'type': 'primary_key', 'name': table_catalog['primary_key_column']})
+        recorder.create_table_file(table_name, schemas)
+
+        rows = []
+        if table_paths[table_name] is not None:
+            rows = read_legacy_rows(table_paths[table_name], table_catalog)
+        for start in xrange(0, len(rows), BATCH_SIZE):
+            recorder.insert_records(table_name, rows[start:start + BATCH_SIZE])
+
+        print 'Table %s: %d records.' % (table_name, len(rows))
+
+    for index_name, (table_name, column) in indexes.iteritems():
+        if index_name not in recorder.index_dict:
+            recorder.create_index(table_name, index_name, column)
+
+    api.close()
+
+
+if __name__ == '__main__':
+    upgrade()
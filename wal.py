@@ -0,0 +1,117 @@
+#
+# Write-ahead log.
+#
+# Every change is appended as one pickled record, framed with its length,
+# a CRC and a log sequence number (LSN). Records are buffered and reach
+# the disk with a single fsync for a whole group of statements; a torn
+# record at the end of the file is ignored when the log is read back.
+#
+
+import os
+import pickle
+import struct
+import time
+import zlib
+
+import config
+
+FRAME = struct.Struct('<IIq')        # payload length, crc32, lsn
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class WriteAheadLog(object):
+
+    def __init__(self, path):
+        self.path = path
+
+        self.lsn = 0                # last assigned
+        self.synced_lsn = 0         # last one known to be on disk
+        self.replaying = False
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._pending = 0           # committed statements not yet synced
+        self._last_sync = time.time()
+
+        self.syncs = 0
+
+        self.raw_file = open(path, 'ab')
+
+    def records(self):
+        """yield (lsn, record) for every complete record in the file"""
+        log_file = open(self.path, 'rb')
+        try:
+            while True:
+                header = log_file.read(FRAME.size)
+                if len(header) < FRAME.size:
+                    return
+
+                length, crc, lsn = FRAME.unpack(header)
+                payload = log_file.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    return
+
+                yield lsn, pickle.loads(payload)
+        finally:
+            log_file.close()
+
+    def append(self, *record):
+        if self.replaying:
+            return
+
+        self.lsn += 1
+        payload = pickle.dumps(record, 2)
+        self._buffer.append(FRAME.pack(len(payload), zlib.crc32(payload) & 0xffffffff, self.lsn))
+        self._buffer.append(payload)
+        self._buffered_bytes += FRAME.size + len(payload)
+
+        if self._buffered_bytes >= WRITE_BUFFER_SIZE:
+            self._write()
+
+    def _write(self):
+        if self._buffer:
+            self.raw_file.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered_bytes = 0
+
+    def sync(self):
+        """force every appended record to disk"""
+        if self.synced_lsn == self.lsn:
+            return
+
+        self._write()
+        self.raw_file.flush()
+        os.fsync(self.raw_file.fileno())
+
+        self.synced_lsn = self.lsn
+        self._pending = 0
+        self._last_sync = time.time()
+        self.syncs += 1
+
+    def commit(self):
+        """end of a statement; the group is synced once it is big or old enough"""
+        self._pending += 1
+        if self._pending >= config.group_commit_size or \
+                time.time() - self._last_sync >= config.group_commit_interval:
+            self.sync()
+
+    def size(self):
+        return self.raw_file.tell() + self._buffered_bytes
+
+    def truncate(self):
+        """drop every record, used once a checkpoint made them redundant"""
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._pending = 0
+
+        self.raw_file.close()
+        self.raw_file = open(self.path, 'wb')
+        os.fsync(self.raw_file.fileno())
+        self.raw_file.close()
+        self.raw_file = open(self.path, 'ab')
+
+        self.synced_lsn = self.lsn
+
+    def close(self):
+        self.sync()
+        self.raw_file.close()